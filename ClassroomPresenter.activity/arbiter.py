@@ -45,6 +45,12 @@
 # 'instructor_ink_cleared' -
 # 'instructor_ink_removed' -
 # 'undo_redo_changed' - 
+# 'thumbnail_ready' - emitted when a thumbnail asked for with do_request_thumbnail has been
+#                     written (with one parameter: the slide index)
+# 'thumbnail_failed' - emitted when a thumbnail asked for with do_request_thumbnail could not
+#                      be rendered (with one parameter: the slide index)
+# 'ink_streamed' - emitted by the slide viewer while a stroke is being drawn, with the
+#                  points drawn since the last time (as a serialized ink path)
 
 import logging
 import gobject
@@ -74,6 +80,7 @@ class Arbiter(gobject.GObject):
         self.__deck = None
         self.__shared = None
         self.__renderer = None
+        self.__thumbnailer = None
         self.__slide_viewer = None
         self.__text_area = None
         self.__nav_tb = None
@@ -96,6 +103,10 @@ class Arbiter(gobject.GObject):
         self.__renderer = renderer
         self.__logger.debug('Renderer registered with Arbiter!')
 
+    def register_thumbnailer(self, thumbnailer):
+        self.__thumbnailer = thumbnailer
+        self.__logger.debug('ThumbnailPool registered with Arbiter!')
+
     def register_slide_viewer(self, slide_viewer):
         self.__slide_viewer = slide_viewer
         self.__logger.debug('SlideViewer registered with Arbiter!')
@@ -204,6 +215,12 @@ class Arbiter(gobject.GObject):
     def do_set_slide_thumb(self, filename, n=-1):
         self.__deck.set_slide_thumb(filename, n)
 
+    def do_set_slide_info(self, width, height, layer_info, n=-1):
+        self.__deck.set_slide_info(width, height, layer_info, n)
+
+    def do_set_layer_digests(self, digests):
+        self.__deck.set_layer_digests(digests)
+
     def do_set_slide_text(self, textval):
         self.__deck.set_slide_text(textval)
 
@@ -243,6 +260,9 @@ class Arbiter(gobject.GObject):
     def do_deck_save(self):
         self.__deck.save()
 
+    def do_deck_flush(self):
+        self.__deck.flush()
+
     def connect_slide_changed(self, cb):
         self.__deck.connect('slide-changed', cb)
 
@@ -293,6 +313,12 @@ class Arbiter(gobject.GObject):
     def get_can_undo_redo(self):
         return self.__slide_viewer.can_undo_redo()
 
+    def do_add_streamed_ink(self, inkstr, n):
+        self.__slide_viewer.add_streamed_ink(inkstr, n)
+
+    def connect_ink_streamed(self, cb):
+        self.__slide_viewer.connect('ink-streamed', cb)
+
     def get_pen_color(self):
         return self.__slide_viewer.get_color()
 
@@ -319,4 +345,45 @@ class Arbiter(gobject.GObject):
     def do_render_slide_to_surface(self, surface, n=None):
         self.__renderer.render_slide_to_surface(surface, n)
 
+    def get_rendered_slide(self, width, height, n=None):
+        return self.__renderer.get_slide_surface(width, height, n)
+
+    def get_slide_dimensions(self, n=None):
+        return self.__renderer.getSlideDimensions(n)
+
+    def get_slide_is_rendered(self, width, height, n=None):
+        return self.__renderer.has_slide_surface(width, height, n)
+
+    def get_slide_preview(self, width, height, n=None):
+        return self.__renderer.get_slide_preview(width, height, n)
+
+    def get_scaled_slide(self, surface, width, height, n=None):
+        return self.__renderer.scale_surface(surface, width, height, n)
+
+    def get_slide_thumbnail(self, n):
+        return self.__renderer.get_thumbnail(n)
+
+    def get_render_timings(self):
+        return self.__renderer.get_render_timings()
+
+    def get_thumbnail_cache_stats(self):
+        return self.__renderer.get_thumbnail_cache_stats()
+
+    def do_prefetch_slide(self, width, height, n):
+        self.__renderer.prefetch_slide(width, height, n)
+
+    # ThumbnailPool mediation
+
+    def do_request_thumbnail(self, n):
+        self.__thumbnailer.request(n)
+
+    def do_stop_thumbnails(self):
+        self.__thumbnailer.stop()
+
+    def connect_thumbnail_ready(self, cb):
+        self.__thumbnailer.connect('thumbnail-ready', cb)
+
+    def connect_thumbnail_failed(self, cb):
+        self.__thumbnailer.connect('thumbnail-failed', cb)
+
 gobject.type_register(Arbiter)
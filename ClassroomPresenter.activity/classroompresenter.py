@@ -24,11 +24,13 @@ import logging
 import sys, os
 import gtk
 import zipfile
+import hashlib
 import gobject
 
 import slideviewer
 import sidebar
 import sliderenderer
+import thumbnailer
 import slideshow
 import textarea
 import toolbars
@@ -84,6 +86,8 @@ class ClassroomPresenter(activity.Activity):
         # renders slides and thumbnails
         self.__renderer = sliderenderer.Renderer(self.__arbiter)
         self.__arbiter.register_renderer(self.__renderer)
+        self.__thumbnailer = thumbnailer.ThumbnailPool(self.__arbiter)
+        self.__arbiter.register_thumbnailer(self.__thumbnailer)
         
         # Set up the main canvas
         self.__slide_view = gtk.HBox()
@@ -165,17 +169,27 @@ class ClassroomPresenter(activity.Activity):
     def can_close(self):
         """ Overrides the inherited method. Tells us the activity wants to quit. """
         self.emit('quitting'); # lets everyone know we're quitting, to do any last minute work
+        self.__arbiter.do_deck_save() # compact the ink journal back into deck.xml
         return True
             
     def read_file(self, file_path):
         self.__logger.debug("read_file " + str(file_path))
         ftype = utils.getFileType(file_path)
+        # Stop the thumbnail workers first, so none of them writes a thumbnail of the old
+        # deck over the new one's
+        self.__arbiter.do_stop_thumbnails()
         z = zipfile.ZipFile(file_path, "r")
+        # The files are hashed while they are in memory anyway, so the deck can tell
+        # which stored slide sizes were stored for other layer files
+        digests = {}
         for i in z.infolist():
+            data = z.read(i.filename)
+            digests[i.filename] = hashlib.sha1(data).hexdigest()
             f = open(os.path.join(self.__deck_dir, i.filename), "wb")
-            f.write(z.read(i.filename))
+            f.write(data)
             f.close()
         z.close()
+        self.__arbiter.do_set_layer_digests(digests)
         self.__arbiter.do_reload_deck()
         newindex = 0
         if 'current_index' in self.metadata:
@@ -186,7 +200,7 @@ class ClassroomPresenter(activity.Activity):
         self.__logger.debug("write_file " + str(file_path))
         self.metadata['mime_type'] = "application/x-classroompresenter"
         self.metadata['current_index'] = str(self.__arbiter.get_slide_index())
-        self.__arbiter.do_deck_save()
+        self.__arbiter.do_deck_flush()
         z = zipfile.ZipFile(file_path, "w")
         root, dirs, files = os.walk(self.__deck_dir).next()
         for f in files:
@@ -0,0 +1,243 @@
+# export.py
+#
+# Renders every slide of a deck to PNG files or a multi-page PDF without running the
+# activity, for batch export of lecture notes and for timing the renderer.
+#
+#   python export.py [options] (deck.cpxo | deck folder) output
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import zipfile
+import hashlib
+import logging
+import optparse
+import cairo
+import gtk
+
+import sliderenderer
+import slideshow
+import ink
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python before 2.6; the slides are rendered one after another
+    multiprocessing = None
+
+USAGE = "%prog [options] (deck.cpxo | deck folder) output"
+
+class _ExportArbiter(object):
+    """Stands in for the activity's arbiter while the deck is read; the exporter is not
+    the instructor and is never locked to the instructor's slide"""
+
+    def get_is_instructor(self):
+        return False
+
+    def get_lock_mode(self):
+        return False
+
+def _output_size(srcw, srch, width):
+    """Returns the integer size of the page for a slide of size srcw x srch, width wide
+    (or at the size of the slide if width is None) with the height keeping its shape"""
+    if width is None:
+        return (int(round(srcw)), int(round(srch)))
+    return (int(width), int(round(width * float(srch) / srcw)))
+
+def draw_ink(ctx, inkstrs, scale=1.0):
+    """Draws the serialized ink paths onto ctx.  Ink is recorded in the pixels of the
+    slide view it was drawn on, so scale converts from those to the page."""
+    ctx.save()
+    ctx.scale(scale, scale)
+    ctx.set_line_cap(cairo.LINE_CAP_ROUND)
+    ctx.set_line_join(cairo.LINE_JOIN_ROUND)
+    sliderenderer.draw_ink_paths(ctx, ink.paths_from_strings(inkstrs))
+    ctx.restore()
+
+def render_png(job):
+    """Renders one slide to a PNG file and returns the slide index.  Runs in a worker
+    process, so everything it needs is in job: (slide index, layer files, slide size or
+    None to take it from the first layer, ink strings, page width or None, ink scale,
+    output file)."""
+    n, layers, dims, inkstrs, width, ink_scale, filename = job
+    srcw, srch = sliderenderer.slide_size(layers, dims)
+    targw, targh = _output_size(srcw, srch, width)
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, targw, targh)
+    sliderenderer.draw_slide(surface, float(srcw), float(srch), layers, sliderenderer.open_layer)
+    draw_ink(cairo.Context(surface), inkstrs, ink_scale)
+    surface.write_to_png(filename)
+    return n
+
+def write_pdf(jobs, filename):
+    """Renders the slides of jobs (as for render_png) as the pages of one PDF file.  The
+    pages of a PDF surface can only be drawn in order, so this runs in one process."""
+    pdf = None
+    for n, layers, dims, inkstrs, width, ink_scale, ignored in jobs:
+        srcw, srch = sliderenderer.slide_size(layers, dims)
+        targw, targh = _output_size(srcw, srch, width)
+        if pdf is None:
+            pdf = cairo.PDFSurface(filename, targw, targh)
+        else:
+            pdf.set_size(targw, targh)
+        ctx = gtk.gdk.CairoContext(cairo.Context(pdf))
+        ctx.save()
+        sliderenderer.draw_layers(ctx, targw, targh, float(srcw), float(srch), layers,
+                                  sliderenderer.open_layer)
+        ctx.restore()
+        draw_ink(ctx, inkstrs, ink_scale)
+        ctx.show_page()
+    if pdf is not None:
+        pdf.finish()
+
+def _write_deck_file(workdir, name, data, digests):
+    f = open(os.path.join(workdir, name), "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    digests[name] = hashlib.sha1(data).hexdigest()
+
+def open_deck(path):
+    """Returns (deck, folder to remove afterwards) for a .cpxo file or a deck folder.
+    Either is first copied to a folder of its own, since reading a deck can tidy up its
+    journal and the exporter must leave its input alone.  Any changes still in the
+    journal are applied, as in the activity."""
+    workdir = tempfile.mkdtemp(prefix="cpxo-export-")
+    try:
+        # The files are hashed as they are copied, as in ClassroomPresenter.read_file, so
+        # stored slide sizes are only used for the layer files they were stored for
+        digests = {}
+        if os.path.isdir(path):
+            # decks are saved flat, as in ClassroomPresenter.write_file
+            root, dirs, files = os.walk(path).next()
+            for name in files:
+                f = open(os.path.join(root, name), "rb")
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                _write_deck_file(workdir, name, data, digests)
+        else:
+            z = zipfile.ZipFile(path, "r")
+            try:
+                for i in z.infolist():
+                    _write_deck_file(workdir, os.path.basename(i.filename), z.read(i.filename), digests)
+            finally:
+                z.close()
+        if not os.path.exists(os.path.join(workdir, "deck.xml")):
+            raise IOError("No deck.xml in " + path)
+        return (slideshow.Deck(_ExportArbiter(), base=workdir, layer_digests=digests), workdir)
+    except:
+        shutil.rmtree(workdir)
+        raise
+
+def make_jobs(deck, output, fmt, instructor=False, submission=None, width=None, ink_scale=1.0):
+    """Returns the render_png/write_pdf jobs for every slide of deck.  The instructor ink
+    is drawn if instructor is true, and the submission from the named student if there
+    is one for the slide."""
+    jobs = []
+    for n in range(deck.get_slide_count()):
+        deck.goto_slide(n, local_request=False)
+        inkstrs = []
+        if instructor:
+            inkstrs.extend(deck.get_instructor_ink())
+        if submission is not None:
+            names = deck.get_submission_list(n)
+            if submission in names:
+                deck.set_active_submission(names.index(submission))
+                inkstrs.extend(deck.get_self_ink_or_submission()[0])
+        layers = deck.get_slide_layers(n)
+        dims = deck.get_slide_dimensions_from_xml(n)
+        if dims == False:
+            dims = None
+        filename = None
+        if fmt == "png":
+            filename = os.path.join(output, "slide%03d.png" % (n + 1))
+        jobs.append((n, layers, dims, inkstrs, width, ink_scale, filename))
+    return jobs
+
+def export(jobs, output, fmt, processes=None):
+    """Renders jobs (from make_jobs) to PNG files, in a pool of processes (one per
+    processor unless processes is given), or to the PDF file output"""
+    if fmt == "pdf":
+        write_pdf(jobs, output)
+    elif multiprocessing is None or processes == 1:
+        map(render_png, jobs)
+    else:
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(render_png, jobs)
+        finally:
+            pool.terminate()
+
+def main(argv):
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option("-f", "--format", choices=["png", "pdf"],
+                      help="png (a folder of images) or pdf; by default, pdf if output ends in .pdf")
+    parser.add_option("-i", "--instructor", action="store_true", default=False,
+                      help="draw the instructor's ink")
+    parser.add_option("-s", "--submission", metavar="NAME",
+                      help="draw the ink that NAME submitted for each slide")
+    parser.add_option("-w", "--width", type="int",
+                      help="width of each page in pixels; by default the size of the slide")
+    parser.add_option("--ink-scale", type="float", default=1.0,
+                      help="scale from the slide view the ink was drawn on to the page")
+    parser.add_option("-j", "--jobs", type="int",
+                      help="number of slides to render at once; by default one per processor")
+    parser.add_option("-v", "--verbose", action="store_true", default=False)
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("need a deck and an output")
+    source, output = args
+
+    handler = logging.StreamHandler()
+    if not options.verbose:
+        handler.setLevel(logging.WARNING)
+    logging.getLogger().addHandler(handler)
+
+    fmt = options.format
+    if fmt is None:
+        fmt = "png"
+        if output.lower().endswith(".pdf"):
+            fmt = "pdf"
+    if fmt == "png" and not os.path.isdir(output):
+        os.makedirs(output)
+
+    timerstart = time.time()
+    try:
+        deck, workdir = open_deck(source)
+    except (IOError, zipfile.BadZipfile), e:
+        print >> sys.stderr, "Can't read %s: %s" % (source, e)
+        return 1
+    try:
+        jobs = make_jobs(deck, output, fmt, options.instructor, options.submission,
+                         options.width, options.ink_scale)
+        loaded = time.time()
+        export(jobs, output, fmt, options.jobs)
+    finally:
+        shutil.rmtree(workdir)
+    done = time.time()
+    print "Exported %d slides to %s in %.2f seconds (%.2f reading the deck, %.2f rendering)" % (
+        len(jobs), output, done - timerstart, loaded - timerstart, done - loaded)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
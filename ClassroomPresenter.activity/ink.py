@@ -19,45 +19,347 @@
 
 import random
 import logging
+import array
+import inkcodec
 
-class Path:
+_logger = logging.getLogger('Path')
+_logger.setLevel(logging.DEBUG)
 
-    def __init__(self, inkstr=None):
+class Path(object):
+    """A single ink stroke.  The points are kept flattened as x0, y0, x1, y1, ... in a
+    packed integer array rather than as a list of tuples, since every stroke on a
+    slide is held in memory while the slide is shown."""
 
-        self.__logger = logging.getLogger('Path')
-        self.__logger.setLevel(logging.DEBUG)
+    __slots__ = ('coords', 'color', 'pen', 'uid', '_bbox')
 
-        self.points=[]
+    def __init__(self, inkstr=None):
+        self._bbox = None
+        self.coords = array.array('i')
         self.color = (0,0,1.0)
         self.pen = 4
-        self.uid = random.randint(0, 2147483647)
+        self.uid = None
         if inkstr:
             try:
-                i=0
-                parts = inkstr.split('#')
-                if len(parts) > 1:
-                    params = parts[i].split(';')
-                    self.uid = int(params[0])
-                    colorparts = params[1].split(',')
-                    self.color = (float(colorparts[0]),float(colorparts[1]),float(colorparts[2]))
-                    self.pen = float(params[2])
-                    i = i + 1
-                    pathstr = parts[i]
-                    pointstrs = pathstr.split(';')
-                    for pointstr in pointstrs:
-                        pparts = pointstr.split(',')
-                        if len(pparts) == 2:
-                            self.add((int(pparts[0]), int(pparts[1])))
-            except Exception, e:
-                self.__logger.debug('Could not unserialize ink string (old ink?)')
-                
+                self.uid, self.color, self.pen, self.coords = inkcodec.decode(inkstr)
+            except inkcodec.InkFormatError, e:
+                # keep what can be read, so old ink keeps its uid and points
+                _logger.debug('Could not unserialize ink string (old ink?): %s', e)
+                uid, color, pen, self.coords = inkcodec.decode_lenient(inkstr)
+                self.uid = uid
+                if color is not None:
+                    self.color = color
+                if pen is not None:
+                    self.pen = pen
+        if self.uid is None:
+            self.uid = random.randint(0, 2147483647)
+
+    def from_fields(cls, fields):
+        """Builds a Path from the (uid, color, pen, coords) tuple inkcodec.decode returns"""
+        path = cls.__new__(cls)
+        path._bbox = None
+        path.uid, path.color, path.pen, path.coords = fields
+        return path
+    from_fields = classmethod(from_fields)
+
     def add(self, point):
-        self.points.append(point)
-        
+        x = int(point[0])
+        y = int(point[1])
+        self.coords.append(x)
+        self.coords.append(y)
+        if self._bbox is not None:
+            # grow the cached box rather than recomputing it, as strokes are drawn point by point
+            r = self.pen / 2.0
+            x0, y0, x1, y1 = self._bbox
+            self._bbox = (min(x0, x - r), min(y0, y - r), max(x1, x + r), max(y1, y + r))
+
+    def extend(self, coords):
+        """Appends flattened x, y coordinates to the stroke"""
+        self.coords.extend(coords)
+        self._bbox = None
+
+    def get_bbox(self):
+        """Returns the (x0, y0, x1, y1) box the stroke is drawn within, pen width
+        included, or None for an empty stroke"""
+        if self._bbox is None and len(self.coords) > 0:
+            xs = self.coords[0::2]
+            ys = self.coords[1::2]
+            r = self.pen / 2.0
+            self._bbox = (min(xs) - r, min(ys) - r, max(xs) + r, max(ys) + r)
+        return self._bbox
+    bbox = property(get_bbox)
+
+    def distance_to(self, x, y):
+        """Returns the distance from (x, y) to the centre line of the stroke"""
+        coords = self.coords
+        if len(coords) == 0:
+            return float('inf')
+        px = coords[0]
+        py = coords[1]
+        best = (x - px) * (x - px) + (y - py) * (y - py)
+        for i in xrange(2, len(coords), 2):
+            qx = coords[i]
+            qy = coords[i + 1]
+            dx = qx - px
+            dy = qy - py
+            len2 = dx * dx + dy * dy
+            t = 0.0
+            if len2 > 0:
+                t = max(0.0, min(1.0, float((x - px) * dx + (y - py) * dy) / len2))
+            ex = px + t * dx - x
+            ey = py + t * dy - y
+            best = min(best, ex * ex + ey * ey)
+            px = qx
+            py = qy
+        return best ** 0.5
+
+    def get_points(self):
+        """Returns the points of the stroke as a list of (x, y) tuples"""
+        coords = self.coords
+        return zip(coords[0::2], coords[1::2])
+    points = property(get_points)
+
+    def __len__(self):
+        return len(self.coords) // 2
+
+    def simplify(self, tolerance):
+        """Drops points lying within tolerance pixels of the simplified stroke; returns
+        the number of points (before, after)"""
+        before = len(self)
+        self.coords = simplify_coords(self.coords, tolerance)
+        self._bbox = None
+        return before, len(self)
+
     def __str__(self):
-        s = str(self.uid) + ";"
-        s = s +  str(self.color[0]) + "," + str(self.color[1]) + "," + str(self.color[2]) + ";"
-        s = s + str(self.pen) + "#"
-        for p in self.points:
-            s = s + str(int(p[0])) + "," + str(int(p[1])) + ";"
-        return s
+        return inkcodec.encode(self.uid, self.color, self.pen, self.coords)
+
+def simplify_coords(coords, tolerance):
+    """Ramer-Douglas-Peucker simplification of a flat x0, y0, x1, y1, ... array.  The
+    end points are always kept, as is every point further than tolerance pixels from
+    the line through the points kept on either side of it.  Returns a new array."""
+    n = len(coords) // 2
+    if n < 3 or tolerance <= 0:
+        return array.array('i', coords)
+    keep = [False] * n
+    keep[0] = keep[n - 1] = True
+    tol2 = tolerance * tolerance
+    # An explicit stack of spans rather than recursion, so long strokes can't hit the
+    # recursion limit
+    spans = [(0, n - 1)]
+    while spans:
+        first, last = spans.pop()
+        x0 = coords[2 * first]
+        y0 = coords[2 * first + 1]
+        dx = coords[2 * last] - x0
+        dy = coords[2 * last + 1] - y0
+        len2 = dx * dx + dy * dy
+        worst = -1
+        worst_d2 = 0
+        for i in xrange(first + 1, last):
+            px = coords[2 * i] - x0
+            py = coords[2 * i + 1] - y0
+            if len2 == 0:
+                # closed span: distance to the end point
+                d2 = px * px + py * py
+            else:
+                # squared distance to the line through the span's end points
+                cross = px * dy - py * dx
+                d2 = float(cross * cross) / len2
+            if d2 > worst_d2:
+                worst = i
+                worst_d2 = d2
+        if worst_d2 > tol2:
+            keep[worst] = True
+            spans.append((first, worst))
+            spans.append((worst, last))
+    simplified = array.array('i')
+    for i in xrange(n):
+        if keep[i]:
+            simplified.append(coords[2 * i])
+            simplified.append(coords[2 * i + 1])
+    return simplified
+
+def paths_from_strings(inkstrs):
+    """Decodes all of the serialized strokes of a slide into Paths.  Malformed strokes
+    are read as leniently as Path does, keeping their uid and any well-formed points."""
+    errors = []
+    paths = []
+    for fields in inkcodec.decode_many(inkstrs, errors):
+        paths.append(Path.from_fields(fields))
+    if len(errors) > 0:
+        # decode_many left the malformed strokes out; put them back in their places
+        for i, e in errors:
+            _logger.debug('Reading stroke %d leniently: %s', i, e)
+            paths.insert(i, Path(inkstrs[i]))
+    return paths
+
+def parse_uid(pathstr):
+    """Returns the uid prefix of a serialized ink path, or 0 for old ink without one"""
+    try:
+        return int(pathstr[0:pathstr.find(';')])
+    except ValueError:
+        return 0
+
+class StrokeIndex(object):
+    """An ordered collection of strokes that can be looked up and removed by uid in
+    constant time.  Strokes may be serialized path strings (the default) or Path
+    objects (pass uid_of=path_uid).  Several strokes may share a uid; old ink without
+    a uid is filed under 0, which is what removal by uid has always matched it as."""
+
+    def __init__(self, strokes=(), uid_of=parse_uid):
+        self.__uid_of = uid_of
+        self.__strokes = {}     # key -> stroke
+        self.__uids = {}        # uid -> list of keys
+        self.__order = []       # keys in drawing order, including removed ones
+        self.__next_key = 0
+        for stroke in strokes:
+            self.append(stroke)
+
+    def append(self, stroke):
+        key = self.__next_key
+        self.__next_key = key + 1
+        self.__strokes[key] = stroke
+        self.__uids.setdefault(self.__uid_of(stroke), []).append(key)
+        self.__order.append(key)
+
+    def get(self, uid):
+        """Returns the strokes with the given uid"""
+        strokes = []
+        for key in self.__uids.get(uid, []):
+            strokes.append(self.__strokes[key])
+        return strokes
+
+    def has_uid(self, uid):
+        return uid in self.__uids
+
+    def remove_uid(self, uid):
+        """Removes every stroke with the given uid; returns the removed strokes"""
+        removed = []
+        for key in self.__uids.pop(uid, []):
+            removed.append(self.__strokes.pop(key))
+        self.__compact()
+        return removed
+
+    def remove(self, stroke):
+        """Removes this particular stroke (by identity); returns True if it was present"""
+        uid = self.__uid_of(stroke)
+        keys = self.__uids.get(uid, [])
+        for key in keys:
+            if self.__strokes[key] is stroke:
+                keys.remove(key)
+                if len(keys) == 0:
+                    del self.__uids[uid]
+                del self.__strokes[key]
+                self.__compact()
+                return True
+        return False
+
+    def __compact(self):
+        # Removed keys are left in the order list until they make up half of it
+        if len(self.__order) > 2 * len(self.__strokes) + 16:
+            order = []
+            for key in self.__order:
+                if key in self.__strokes:
+                    order.append(key)
+            self.__order = order
+
+    def __iter__(self):
+        for key in self.__order:
+            if key in self.__strokes:
+                yield self.__strokes[key]
+
+    def __len__(self):
+        return len(self.__strokes)
+
+def path_uid(path):
+    return path.uid
+
+class StrokeGrid(object):
+    """A uniform grid over the bounding boxes of Path objects, for finding the strokes
+    that touch a region or a point without looking at every stroke on the slide.
+    A stroke that changes shape has to be updated, since it is filed under the cells
+    its old bounding box covered."""
+
+    def __init__(self, cell_size=64):
+        self.__cell_size = cell_size
+        self.__cells = {}       # (column, row) -> list of paths
+        self.__entries = {}     # id(path) -> (sequence number, cells)
+        self.__next_seq = 0
+
+    def __cells_for(self, box):
+        size = self.__cell_size
+        x0, y0, x1, y1 = box
+        cells = []
+        for col in xrange(int(x0 // size), int(x1 // size) + 1):
+            for row in xrange(int(y0 // size), int(y1 // size) + 1):
+                cells.append((col, row))
+        return cells
+
+    def add(self, path):
+        box = path.get_bbox()
+        if box is None or id(path) in self.__entries:
+            return
+        cells = self.__cells_for(box)
+        for cell in cells:
+            self.__cells.setdefault(cell, []).append(path)
+        self.__entries[id(path)] = (self.__next_seq, cells)
+        self.__next_seq += 1
+
+    def remove(self, path):
+        entry = self.__entries.pop(id(path), None)
+        if entry is None:
+            return
+        for cell in entry[1]:
+            paths = self.__cells[cell]
+            for i in xrange(len(paths)):
+                if paths[i] is path:
+                    del paths[i]
+                    break
+            if len(paths) == 0:
+                del self.__cells[cell]
+
+    def update(self, path):
+        """Re-files a stroke whose points have changed, keeping its drawing order"""
+        entry = self.__entries.get(id(path))
+        if entry is None:
+            return
+        self.remove(path)
+        box = path.get_bbox()
+        if box is not None:
+            cells = self.__cells_for(box)
+            for cell in cells:
+                self.__cells.setdefault(cell, []).append(path)
+            self.__entries[id(path)] = (entry[0], cells)
+
+    def clear(self):
+        self.__cells = {}
+        self.__entries = {}
+
+    def query(self, box):
+        """Returns the strokes whose bounding boxes overlap box, in the order they
+        were added"""
+        x0, y0, x1, y1 = box
+        found = {}
+        for cell in self.__cells_for(box):
+            for path in self.__cells.get(cell, ()):
+                bx0, by0, bx1, by1 = path.get_bbox()
+                if bx0 <= x1 and x0 <= bx1 and by0 <= y1 and y0 <= by1:
+                    found[id(path)] = path
+        return self.__in_order(found.values())
+
+    def hit(self, x, y, radius=0):
+        """Returns the topmost stroke drawn within radius of (x, y), or None"""
+        candidates = self.query((x - radius, y - radius, x + radius, y + radius))
+        candidates.reverse()
+        for path in candidates:
+            if path.distance_to(x, y) <= radius + path.pen / 2.0:
+                return path
+        return None
+
+    def __in_order(self, paths):
+        entries = self.__entries
+        decorated = [(entries[id(path)][0], path) for path in paths]
+        decorated.sort()
+        return [path for seq, path in decorated]
+
+    def __len__(self):
+        return len(self.__entries)
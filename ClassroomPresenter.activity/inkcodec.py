@@ -0,0 +1,301 @@
+# inkcodec.py
+#
+# Encoding and decoding of the serialized ink format,
+#   "uid;r,g,b;pen#x,y;x,y;...;"
+# which is what is stored in deck.xml and sent over the D-Bus tube, and of the
+# more compact binary format that newer peers use on the tube instead.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import re
+import array
+import zlib
+
+# A well-formed point list: integer pairs, each terminated by ';' (the last
+# terminator may be missing)
+_POINTS_RE = re.compile(r'(?:-?\d+,-?\d+;)*(?:-?\d+,-?\d+)?\Z')
+
+class InkFormatError(ValueError):
+    """ Raised when a serialized ink string cannot be decoded """
+    pass
+
+def encode(uid, color, pen, coords):
+    """Returns the serialized form of a stroke.  coords is a flat sequence of
+    x0, y0, x1, y1, ... integers.  The output is byte-for-byte what ink.Path
+    has always produced."""
+    header = "%s;%s,%s,%s;%s#" % (uid, color[0], color[1], color[2], pen)
+    return header + ("%d,%d;" * (len(coords) // 2)) % tuple(coords)
+
+def decode_points(pointstr):
+    """Parses "x,y;x,y;..." into a flat array('i') of coordinates"""
+    if not _POINTS_RE.match(pointstr):
+        raise InkFormatError("malformed point list: %r" % pointstr[:40])
+    if pointstr.endswith(';'):
+        pointstr = pointstr[:-1]
+    if not pointstr:
+        return array.array('i')
+    try:
+        return array.array('i', map(int, pointstr.replace(';', ',').split(',')))
+    except OverflowError:
+        raise InkFormatError("coordinate out of range in %r" % pointstr[:40])
+
+def decode(inkstr):
+    """Parses a serialized stroke and returns (uid, color, pen, coords).  Raises
+    InkFormatError, naming the offending part, if inkstr is malformed."""
+    sep = inkstr.find('#')
+    if sep < 0:
+        raise InkFormatError("no '#' between header and points in %r" % inkstr[:40])
+    params = inkstr[:sep].split(';')
+    if len(params) != 3:
+        raise InkFormatError("header should be uid;r,g,b;pen, not %r" % inkstr[:sep])
+    try:
+        uid = int(params[0])
+    except ValueError:
+        raise InkFormatError("bad uid %r" % params[0])
+    colorparts = params[1].split(',')
+    if len(colorparts) != 3:
+        raise InkFormatError("bad color %r" % params[1])
+    try:
+        color = (float(colorparts[0]), float(colorparts[1]), float(colorparts[2]))
+    except ValueError:
+        raise InkFormatError("bad color %r" % params[1])
+    try:
+        pen = float(params[2])
+    except ValueError:
+        raise InkFormatError("bad pen width %r" % params[2])
+    return (uid, color, pen, decode_points(inkstr[sep + 1:]))
+
+def decode_lenient(inkstr):
+    """Parses a serialized stroke the way ink.Path did before decoding was strict, for
+    old or damaged ink: as much of the header as can be read is kept, and so are the
+    points up to the first malformed one.  Returns (uid, color, pen, coords), with None
+    for any of uid, color and pen that could not be read."""
+    uid = None
+    color = None
+    pen = None
+    coords = array.array('i')
+    parts = inkstr.split('#')
+    if len(parts) < 2:
+        return (uid, color, pen, coords)
+    params = parts[0].split(';')
+    try:
+        uid = int(params[0])
+        colorparts = params[1].split(',')
+        color = (float(colorparts[0]), float(colorparts[1]), float(colorparts[2]))
+        pen = float(params[2])
+    except (ValueError, IndexError):
+        pass
+    for pointstr in parts[1].split(';'):
+        pparts = pointstr.split(',')
+        if len(pparts) != 2:
+            continue
+        try:
+            x = int(pparts[0])
+            y = int(pparts[1])
+            coords.append(x)
+            coords.append(y)
+        except (ValueError, OverflowError):
+            break
+    return (uid, color, pen, coords)
+
+def decode_many(inkstrs, errors=None):
+    """Decodes every stroke of a slide.  If errors is a list, malformed strokes are
+    skipped and (index, InkFormatError) pairs appended to it; otherwise the first
+    malformed stroke raises."""
+    strokes = []
+    for i in xrange(len(inkstrs)):
+        try:
+            strokes.append(decode(inkstrs[i]))
+        except InkFormatError, e:
+            if errors is None:
+                raise
+            errors.append((i, e))
+    return strokes
+
+# --- Binary format ---
+#
+# A compact alternative to the text format for sending ink over the network.
+# A message is a format version byte followed by one or more strokes, each:
+#
+#   uid                  zigzag varint
+#   color and pen        varint length, then the "r,g,b;pen" text of the stroke
+#   number of points     varint
+#   coordinates          zigzag varints; the first point absolute, the rest
+#                        as deltas from the previous point
+#
+# The color and pen are kept as text so that a stroke converted to binary and
+# back gives exactly the string it started as.  Pen-sampled strokes move a few
+# pixels per point, so most deltas fit in one byte per coordinate.
+#
+# Large messages (whole submissions) may instead start with the version byte
+# BINARY_VERSION_ZLIB, followed by a zlib stream of an ordinary message.
+
+BINARY_VERSION = 1
+BINARY_VERSION_ZLIB = 2
+
+def _put_varint(out, value):
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value = value >> 7
+    out.append(chr(value))
+
+def _put_zigzag(out, value):
+    if value < 0:
+        _put_varint(out, (-value << 1) - 1)
+    else:
+        _put_varint(out, value << 1)
+
+def _get_varint(data, pos):
+    """Returns (value, new position)"""
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise InkFormatError("binary ink truncated")
+        byte = ord(data[pos])
+        pos = pos + 1
+        value = value | ((byte & 0x7f) << shift)
+        if byte < 0x80:
+            return value, pos
+        shift = shift + 7
+
+def _get_zigzag(data, pos):
+    value, pos = _get_varint(data, pos)
+    if value & 1:
+        return -((value + 1) >> 1), pos
+    return value >> 1, pos
+
+def encode_binary(inkstrs):
+    """Packs a list of serialized strokes into the binary format"""
+    out = [chr(BINARY_VERSION)]
+    for inkstr in inkstrs:
+        uid, color, pen, coords = decode(inkstr)
+        sep = inkstr.find('#')
+        style = inkstr[inkstr.find(';') + 1:sep]
+        _put_zigzag(out, uid)
+        _put_varint(out, len(style))
+        out.append(style)
+        _put_varint(out, len(coords) // 2)
+        lastx = 0
+        lasty = 0
+        for i in xrange(0, len(coords), 2):
+            x = coords[i]
+            y = coords[i + 1]
+            _put_zigzag(out, x - lastx)
+            _put_zigzag(out, y - lasty)
+            lastx = x
+            lasty = y
+    return "".join(out)
+
+def compress_binary(data, threshold=0):
+    """Compresses a binary ink message of at least threshold bytes, if that makes it
+    smaller; decode_binary undoes this"""
+    if len(data) < threshold:
+        return data
+    compressed = chr(BINARY_VERSION_ZLIB) + zlib.compress(data)
+    if len(compressed) < len(data):
+        return compressed
+    return data
+
+def decode_binary(data):
+    """Unpacks binary ink into a list of serialized strokes in the text format"""
+    if len(data) >= 1 and ord(data[0]) == BINARY_VERSION_ZLIB:
+        try:
+            data = zlib.decompress(data[1:])
+        except zlib.error, e:
+            raise InkFormatError("bad compressed binary ink: %s" % e)
+    if len(data) < 1 or ord(data[0]) != BINARY_VERSION:
+        raise InkFormatError("unknown binary ink version")
+    inkstrs = []
+    pos = 1
+    while pos < len(data):
+        uid, pos = _get_zigzag(data, pos)
+        length, pos = _get_varint(data, pos)
+        style = data[pos:pos + length]
+        if len(style) != length:
+            raise InkFormatError("binary ink truncated")
+        pos = pos + length
+        npoints, pos = _get_varint(data, pos)
+        coords = array.array('i')
+        x = 0
+        y = 0
+        for i in xrange(npoints):
+            dx, pos = _get_zigzag(data, pos)
+            dy, pos = _get_zigzag(data, pos)
+            x = x + dx
+            y = y + dy
+            coords.append(x)
+            coords.append(y)
+        inkstr = "%d;%s#" % (uid, style) + ("%d,%d;" * npoints) % tuple(coords)
+        # Make sure what comes out is well-formed before anyone stores it
+        decode(inkstr)
+        inkstrs.append(inkstr)
+    return inkstrs
+
+def _legacy_encode(uid, color, pen, points):
+    """The original ink.Path.__str__, kept for the benchmark"""
+    s = str(uid) + ";"
+    s = s +  str(color[0]) + "," + str(color[1]) + "," + str(color[2]) + ";"
+    s = s + str(pen) + "#"
+    for p in points:
+        s = s + str(int(p[0])) + "," + str(int(p[1])) + ";"
+    return s
+
+def _legacy_decode(inkstr):
+    """The original ink.Path parser, kept for the benchmark"""
+    points = []
+    parts = inkstr.split('#')
+    params = parts[0].split(';')
+    uid = int(params[0])
+    colorparts = params[1].split(',')
+    color = (float(colorparts[0]),float(colorparts[1]),float(colorparts[2]))
+    pen = float(params[2])
+    for pointstr in parts[1].split(';'):
+        pparts = pointstr.split(',')
+        if len(pparts) == 2:
+            points.append((int(pparts[0]), int(pparts[1])))
+    return (uid, color, pen, points)
+
+def benchmark(sizes=(1000, 10000, 100000)):
+    """Prints encode/decode throughput, in points per second, for strokes of the
+    given numbers of points, next to the original implementation"""
+    import time
+    import random
+    for npoints in sizes:
+        coords = array.array('i')
+        points = []
+        for i in xrange(npoints):
+            x = random.randint(0, 1200)
+            y = random.randint(0, 900)
+            coords.append(x)
+            coords.append(y)
+            points.append((x, y))
+        color = (0.0, 0.0, 1.0)
+        reps = max(1, 200000 // npoints)
+        results = []
+        for name, func, args in (
+                ("encode", encode, (1234, color, 4.0, coords)),
+                ("legacy encode", _legacy_encode, (1234, color, 4.0, points)),
+                ("decode", decode, (encode(1234, color, 4.0, coords),)),
+                ("legacy decode", _legacy_decode, (encode(1234, color, 4.0, coords),))):
+            start = time.time()
+            for i in xrange(reps):
+                func(*args)
+            elapsed = max(time.time() - start, 1e-9)
+            results.append("%s %.0f pts/s" % (name, npoints * reps / elapsed))
+        print "%6d points: %s" % (npoints, ", ".join(results))
+
+if __name__ == '__main__':
+    benchmark()
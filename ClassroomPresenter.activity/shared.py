@@ -32,12 +32,24 @@ from sugar.presence import presenceservice
 from sugar.presence.tubeconn import TubeConnection
 
 import utils
+import inkcodec
 from sharedslides import SharedSlides
 
 SERVICE = "edu.washington.cs.ClassroomPresenterXO"
 IFACE = SERVICE
 PATH = "/edu/washington/cs/ClassroomPresenterXO"
 
+# Version of the ink protocol spoken on the dbus tube.  Peers that don't answer
+# Negotiate_Ink_Version are older activity versions, which only know:
+INK_VERSION_TEXT = 1    # ink as "uid;r,g,b;pen#x,y;..." strings
+# and the current version adds:
+INK_VERSION_BINARY = 2  # ink packed with inkcodec.encode_binary, sent as byte arrays
+INK_VERSION_COMPRESSED = 3  # large binary submissions may also be zlib-compressed
+INK_VERSION = INK_VERSION_COMPRESSED
+
+# Binary submissions at least this many bytes long are compressed for peers that can take it
+SUBMISSION_COMPRESS_THRESHOLD = 2048
+
 class Shared(ExportedGObject):
 
     __gsignals__ = {
@@ -57,6 +69,11 @@ class Shared(ExportedGObject):
         self.__shared_slides = None
         self.__got_dbus_tube = False
         self.__locked = False
+        # ink protocol versions: of each student (instructor side), of the instructor (student side)
+        self.__peer_ink_versions = {}
+        self.__instructor_ink_version = INK_VERSION_TEXT
+        # submission traffic: text ink bytes, and the bytes actually put on (or taken off) the tube
+        self.__submission_stats = {'sent_raw' : 0, 'sent' : 0, 'received_raw' : 0, 'received' : 0}
         self.__pservice = presenceservice.get_instance()
         #self.__owner = self.__pservice.get_owner()
 
@@ -76,6 +93,11 @@ class Shared(ExportedGObject):
         """ Returns a flag that indicates whether student navigation is locked. """
         return self.__locked
 
+    def get_submission_stats(self):
+        """ Returns a dict of submission byte counts: 'sent_raw' and 'received_raw' count
+            the ink as text, 'sent' and 'received' what went over the tube. """
+        return self.__submission_stats.copy()
+
     def shared_cb(self, activity):
         """ Called when the activity is shared """
         self.__logger.debug('The activity has been shared.')
@@ -90,6 +112,7 @@ class Shared(ExportedGObject):
         self.__arbiter.connect_instructor_ink_removed(self.instr_remove_ink_cb)
         self.__arbiter.connect_ink_broadcast(self.bcast_submission_cb)
         self.__arbiter.connect_lock_button_clicked(self.lock_mode_switch)
+        self.__arbiter.connect_ink_streamed(self.send_ink_stream_cb)
 
         self.shared_setup()
 
@@ -185,6 +208,27 @@ class Shared(ExportedGObject):
         proxy_object = self.__dbus_tube.get_object(sender, PATH)
         proxy_object.Push_Initial_State(self.__locked, self.__arbiter.get_slide_index(),
                                         dbus_interface=IFACE)
+
+        # Until it answers, treat the student as an older version that only knows text ink
+        self.__peer_ink_versions[sender] = INK_VERSION_TEXT
+        proxy_object.Negotiate_Ink_Version(INK_VERSION, dbus_interface=IFACE,
+            reply_handler=lambda version: self.negotiate_reply_cb(sender, version),
+            error_handler=lambda e: self.negotiate_error_cb(sender, e))
+
+    def negotiate_reply_cb(self, sender, version):
+        self.__logger.debug("Student %s speaks ink version %u.", sender, version)
+        self.__peer_ink_versions[sender] = min(version, INK_VERSION)
+
+    def negotiate_error_cb(self, sender, e):
+        self.__logger.debug("Student %s can't negotiate ink version, sending it text ink: %s", sender, e)
+        self.__peer_ink_versions[sender] = INK_VERSION_TEXT
+
+    def get_broadcast_ink_version(self):
+        """ Returns the ink version every student we know of understands """
+        version = INK_VERSION
+        for peer_version in self.__peer_ink_versions.values():
+            version = min(version, peer_version)
+        return version
         
     def list_tubes_reply_cb(self, tubes):
         for tube_info in tubes:
@@ -212,6 +256,9 @@ class Shared(ExportedGObject):
                                                      IFACE, path=PATH, sender_keyword='sender')
                 self.__dbus_tube.add_signal_receiver(self.receive_submission_cb, 'Send_Submission',
                                                      IFACE, path=PATH)
+                self.__dbus_tube.add_signal_receiver(self.receive_binary_submission_cb,
+                                                     'Send_Submission_Binary', IFACE, path=PATH,
+                                                     byte_arrays=True)
             else:
                 # connect to dbus signals sent by instructor
                 self.__dbus_tube.add_signal_receiver(self.slide_changed_cb, 'Slide_Changed',
@@ -226,6 +273,13 @@ class Shared(ExportedGObject):
                                                      IFACE, path=PATH)
                 self.__dbus_tube.add_signal_receiver(self.receive_submission_cb, 'Bcast_Submission',
                                                      IFACE, path=PATH)
+                self.__dbus_tube.add_signal_receiver(self.add_binary_ink_path_cb, 'Add_Ink_Path_Binary',
+                                                     IFACE, path=PATH, byte_arrays=True)
+                self.__dbus_tube.add_signal_receiver(self.ink_stream_cb, 'Stream_Ink',
+                                                     IFACE, path=PATH, byte_arrays=True)
+                self.__dbus_tube.add_signal_receiver(self.receive_binary_submission_cb,
+                                                     'Bcast_Submission_Binary', IFACE, path=PATH,
+                                                     byte_arrays=True)
 
             #self.__dbus_tube.watch_participants(self.participant_change_cb)
 
@@ -264,16 +318,59 @@ class Shared(ExportedGObject):
     def send_ink_path_cb(self, widget, inkstr):
         self.__logger.debug("send_ink_path_cb called")
         if (self.__sharing and self.__got_dbus_tube):
-            self.Add_Ink_Path(self.__arbiter.get_slide_index(), inkstr)
+            if self.get_broadcast_ink_version() >= INK_VERSION_BINARY:
+                try:
+                    data = inkcodec.encode_binary([inkstr])
+                except inkcodec.InkFormatError, e:
+                    # old ink that can't be packed still goes out as text
+                    self.__logger.debug("Sending ink as text: %s", e)
+                    self.Add_Ink_Path(self.__arbiter.get_slide_index(), inkstr)
+                    return
+                self.Add_Ink_Path_Binary(self.__arbiter.get_slide_index(), dbus.ByteArray(data))
+            else:
+                self.Add_Ink_Path(self.__arbiter.get_slide_index(), inkstr)
     
+    def send_ink_stream_cb(self, widget, inkstr):
+        # Older students don't listen for Stream_Ink, so it would only add to the traffic
+        # on the mesh if any of them is in the class; they get the stroke when it's done
+        if (self.__sharing and self.__got_dbus_tube and
+                self.get_broadcast_ink_version() >= INK_VERSION_BINARY):
+            try:
+                data = inkcodec.encode_binary([inkstr])
+            except inkcodec.InkFormatError, e:
+                # the finished stroke is still sent by send_ink_path_cb
+                self.__logger.debug("Not streaming ink: %s", e)
+                return
+            self.Stream_Ink(self.__arbiter.get_slide_index(), dbus.ByteArray(data))
+
     def receive_submission_cb(self, sender, slide_idx, inks, text):
         self.__logger.debug("Received submission from '%s'.", sender)
+        self.__count_submission('received', len(inks), len(inks))
+        self.__arbiter.do_add_submission(sender, inks, text, slide_idx)
+
+    def receive_binary_submission_cb(self, sender, slide_idx, data, text):
+        try:
+            inkstrs = inkcodec.decode_binary(data)
+        except inkcodec.InkFormatError, e:
+            self.__logger.error("Dropping submission from '%s' with bad ink: %s", sender, e)
+            return
+        inks = "".join([s + "$" for s in inkstrs])
+        self.__logger.debug("Received submission from '%s'.", sender)
+        self.__count_submission('received', len(inks), len(data))
         self.__arbiter.do_add_submission(sender, inks, text, slide_idx)
         
     def bcast_submission_cb(self, widget, whofrom, inks, text):
         if self.__sharing and self.__got_dbus_tube:
             cur_idx = self.__arbiter.get_slide_index()
-            self.Bcast_Submission(whofrom, cur_idx, inks, text)
+            version = self.get_broadcast_ink_version()
+            data = None
+            if version >= INK_VERSION_BINARY:
+                data = self.__pack_submission(inks, version)
+            if data is not None:
+                self.Bcast_Submission_Binary(whofrom, cur_idx, data, text)
+            else:
+                self.__count_submission('sent', len(inks), len(inks))
+                self.Bcast_Submission(whofrom, cur_idx, inks, text)
     
     def instr_clear_ink_cb(self, widget, idx):
         if self.__sharing and self.__got_dbus_tube:
@@ -317,6 +414,19 @@ class Shared(ExportedGObject):
     def Bcast_Submission(self, sender, slide_idx, inks, text):
         pass    
 
+    @signal(dbus_interface=IFACE, signature='uay')
+    def Add_Ink_Path_Binary(self, slide_idx, data):
+        self.__logger.debug("Sending new ink path (%d bytes)", len(data))
+        pass
+
+    @signal(dbus_interface=IFACE, signature='suays')
+    def Bcast_Submission_Binary(self, sender, slide_idx, data, text):
+        pass
+
+    @signal(dbus_interface=IFACE, signature='uay')
+    def Stream_Ink(self, slide_idx, data):
+        pass
+
     # --- END Instructor DBus Signals/Methods ---
 
 
@@ -347,6 +457,24 @@ class Shared(ExportedGObject):
         self.__logger.debug("Received new ink path")
         self.__arbiter.do_add_ink_to_slide(inkstr, local_request=False, n=idx)
 
+    def add_binary_ink_path_cb(self, idx, data):
+        try:
+            inkstrs = inkcodec.decode_binary(data)
+        except inkcodec.InkFormatError, e:
+            self.__logger.error("Dropping bad ink path: %s", e)
+            return
+        for inkstr in inkstrs:
+            self.add_ink_path_cb(idx, inkstr)
+
+    def ink_stream_cb(self, idx, data):
+        try:
+            inkstrs = inkcodec.decode_binary(data)
+        except inkcodec.InkFormatError, e:
+            self.__logger.error("Dropping bad streamed ink: %s", e)
+            return
+        for inkstr in inkstrs:
+            self.__arbiter.do_add_streamed_ink(inkstr, idx)
+
     def submit_ink_cb(self, widget, inks, text):
         if not self.__sharing and self.__got_dbus_tube:
             cur_idx = self.__arbiter.get_slide_index()
@@ -359,7 +487,15 @@ class Shared(ExportedGObject):
                 sender = 'Unknown'
 
             self.__logger.debug("Sending submission: idx '%d', sender '%s'.", cur_idx, sender)
-            self.Send_Submission(sender, cur_idx, inks, text)
+            version = self.__instructor_ink_version
+            data = None
+            if version >= INK_VERSION_BINARY:
+                data = self.__pack_submission(inks, version)
+            if data is not None:
+                self.Send_Submission_Binary(sender, cur_idx, data, text)
+            else:
+                self.__count_submission('sent', len(inks), len(inks))
+                self.Send_Submission(sender, cur_idx, inks, text)
     
     # --- END Student CallBacks ---
 
@@ -375,6 +511,17 @@ class Shared(ExportedGObject):
     @signal(dbus_interface=IFACE, signature='suss')
     def Send_Submission(self, sender, slide_idx, inks, text):
         pass
+
+    @signal(dbus_interface=IFACE, signature='suays')
+    def Send_Submission_Binary(self, sender, slide_idx, data, text):
+        pass
+
+    @method(dbus_interface=IFACE, in_signature='u', out_signature='u')
+    def Negotiate_Ink_Version(self, instructor_version):
+        """ Called on student XO by the instructor with its ink protocol version; returns ours """
+        self.__logger.debug("Instructor speaks ink version %u.", instructor_version)
+        self.__instructor_ink_version = min(instructor_version, INK_VERSION)
+        return INK_VERSION
     
     @method(dbus_interface=IFACE, in_signature='uu', out_signature='')
     def Push_Initial_State(self, locked, slide_idx):
@@ -394,6 +541,31 @@ class Shared(ExportedGObject):
 
     # BEGIN Private Methods
 
+    def __pack_submission(self, inks, version):
+        """Packs '$'-separated ink strings into a byte array of binary ink for a peer
+        speaking the given ink version; returns None if the ink is of a form (such as old
+        ink) that can't be packed, so it must be sent as text"""
+        inkstrs = []
+        for part in inks.split("$"):
+            if len(part) > 0:
+                inkstrs.append(part)
+        try:
+            data = inkcodec.encode_binary(inkstrs)
+        except inkcodec.InkFormatError, e:
+            self.__logger.debug("Sending submission as text: %s", e)
+            return None
+        if version >= INK_VERSION_COMPRESSED:
+            data = inkcodec.compress_binary(data, SUBMISSION_COMPRESS_THRESHOLD)
+        self.__count_submission('sent', len(inks), len(data))
+        return dbus.ByteArray(data)
+
+    def __count_submission(self, direction, raw, actual):
+        stats = self.__submission_stats
+        stats[direction + '_raw'] += raw
+        stats[direction] += actual
+        self.__logger.debug("Submission %s: %d bytes of ink as %d bytes; %d of %d bytes in total",
+                            direction, raw, actual, stats[direction], stats[direction + '_raw'])
+
     def _get_buddy(self, cs_handle):
         """Get a Buddy from a channel specific handle."""
         self.__logger.debug('Trying to find owner of handle %u...', cs_handle)
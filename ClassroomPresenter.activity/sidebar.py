@@ -30,6 +30,13 @@ import gobject
 from sugar.graphics import style
 from gettext import gettext as _
 
+# Each thumbnail takes up a row this high in the slide list
+THUMB_ROW_HEIGHT = 160
+THUMB_TILE_WIDTH = 209
+
+# Thumbnails are kept for this many rows above and below the ones in view
+THUMB_OVERSCAN = 2
+
 class SideBar(gtk.Notebook):
     
     def __init__(self, arbiter):
@@ -49,6 +56,11 @@ class SideBar(gtk.Notebook):
         # Scrollbar: horizontal if necessary; vertical always
         self.__viewing_box = gtk.ScrolledWindow()
         self.__viewing_box.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
+        self.__layout = gtk.Layout()
+        self.__viewing_box.add(self.__layout)
+        self.__tiles = {}           # slide index -> (event box, ThumbViewer) of the rows in view
+        self.__spare_tiles = []     # (event box, ThumbViewer) of rows out of view, to reuse
+        self.__highlighted = None   # index of the slide whose thumbnail is highlighted
         slide_label = gtk.Label(_("Slides"))
         event_box = gtk.EventBox()
         event_box.add(self.__viewing_box)
@@ -75,6 +87,11 @@ class SideBar(gtk.Notebook):
         self.show_all()
         
         self.__arbiter.connect_deck_changed(self.load_thumbs)
+        self.__arbiter.connect_thumbnail_ready(self.thumbnail_ready_cb)
+        self.__arbiter.connect_thumbnail_failed(self.thumbnail_failed_cb)
+        self.__arbiter.connect_slide_redraw(self.slide_redraw_cb)
+        self.__viewing_box.get_vadjustment().connect('value-changed', self.__update_visible)
+        self.__layout.connect('size-allocate', self.__update_visible)
         self.__arbiter.connect_update_submissions(self.load_subs)
         self.__sublist.get_selection().connect('changed', self.sub_sel_changed)
         
@@ -97,41 +114,95 @@ class SideBar(gtk.Notebook):
             self.__logger.debug("Submission selection changed to "+ str(newindex))
             self.__arbiter.do_set_active_submission(newindex)
 
-    # Method to load slides into Scrolling side window
-    # The method uses a table to organize the slides
+    # Only the thumbnails in or near the scrolled-to part of the list have widgets; as
+    # the list scrolls, the widgets of rows that go out of view are reused for the rows
+    # coming into view
     def load_thumbs(self, widget=None):
-        for c in self.__viewing_box.get_children():
-            self.__viewing_box.remove(c)
-
-        # create image table for thumbnails
-        self.image_table = gtk.Table(self.__arbiter.get_slide_count(), 1, False)
-
-        # Loop to show slides
-        for i in range(self.__arbiter.get_slide_count()):        
-            # Create event box for table entry
-            event_box = gtk.EventBox()
-            event_box.set_size_request(209, 160)
-
-            # Add navigation to event boxes
-            event_box.set_above_child(True)
-            event_box.connect('button_press_event', self.change_slide, i)
-
-            # Create viewer for slide and add to box
-            slide = slideviewer.ThumbViewer(self.__arbiter, i)
-            event_box.add(slide)
-
-            # Put box in table and show 
-            self.image_table.attach(event_box, 0, 1, i, i+1)
-            event_box.show()            
-
-            # Show each slide
-            slide.show()
-
-        # show images
-        self.__viewing_box.add_with_viewport(self.image_table)
-        self.image_table.show()
-
-
-    def change_slide(self, widget, event, n):
-        self.__arbiter.do_goto_slide(n, local_request=True)
+        for n in self.__tiles.keys():
+            self.__recycle(n)
+        self.__layout.set_size(THUMB_TILE_WIDTH, self.__arbiter.get_slide_count() * THUMB_ROW_HEIGHT)
+        self.__highlighted = self.__arbiter.get_slide_index()
+        self.__update_visible()
+
+    def __update_visible(self, *args):
+        adj = self.__viewing_box.get_vadjustment()
+        height = adj.page_size
+        if height <= 0:
+            height = self.__layout.allocation.height
+        first = max(0, int(adj.value // THUMB_ROW_HEIGHT) - THUMB_OVERSCAN)
+        last = min(self.__arbiter.get_slide_count() - 1,
+                   int((adj.value + height) // THUMB_ROW_HEIGHT) + THUMB_OVERSCAN)
+        for n in self.__tiles.keys():
+            if n < first or n > last:
+                self.__recycle(n)
+        for n in range(first, last + 1):
+            if n not in self.__tiles:
+                if len(self.__spare_tiles) > 0:
+                    event_box, slide = self.__spare_tiles.pop()
+                else:
+                    event_box, slide = self.__new_tile()
+                slide.set_slide(n)
+                slide.set_highlighted(n == self.__highlighted)
+                self.__layout.move(event_box, 0, n * THUMB_ROW_HEIGHT)
+                event_box.show()
+                self.__tiles[n] = (event_box, slide)
+
+    def __new_tile(self):
+        # Create event box for the thumbnail
+        event_box = gtk.EventBox()
+        event_box.set_size_request(THUMB_TILE_WIDTH, THUMB_ROW_HEIGHT)
+        # spare tiles stay hidden when the sidebar is shown
+        event_box.set_no_show_all(True)
+
+        # Add navigation to event boxes
+        event_box.set_above_child(True)
+
+        # Create viewer for slide and add to box
+        slide = slideviewer.ThumbViewer(self.__arbiter)
+        event_box.add(slide)
+        event_box.connect('button_press_event', self.change_slide, slide)
+        slide.show()
+        self.__layout.put(event_box, 0, 0)
+        return event_box, slide
+
+    def __recycle(self, n):
+        event_box, slide = self.__tiles.pop(n)
+        event_box.hide()
+        slide.set_slide(None)
+        slide.set_highlighted(False)
+        self.__spare_tiles.append((event_box, slide))
+
+    def slide_redraw_cb(self, widget):
+        """Moves the highlight to the current slide's thumbnail, and scrolls it into view"""
+        n = self.__arbiter.get_slide_index()
+        if n == self.__highlighted:
+            return
+        if self.__highlighted in self.__tiles:
+            self.__tiles[self.__highlighted][1].set_highlighted(False)
+        self.__highlighted = n
+        self.__scroll_to(n)
+        if n in self.__tiles:
+            self.__tiles[n][1].set_highlighted(True)
+
+    def __scroll_to(self, n):
+        adj = self.__viewing_box.get_vadjustment()
+        top = n * THUMB_ROW_HEIGHT
+        bottom = top + THUMB_ROW_HEIGHT
+        if top < adj.value:
+            adj.set_value(top)
+        elif bottom > adj.value + adj.page_size:
+            adj.set_value(min(bottom - adj.page_size, adj.upper - adj.page_size))
+
+    def thumbnail_ready_cb(self, widget, n):
+        if n in self.__tiles:
+            self.__tiles[n][1].thumbnail_ready()
+
+    def thumbnail_failed_cb(self, widget, n):
+        if n in self.__tiles:
+            self.__tiles[n][1].thumbnail_failed()
+
+    def change_slide(self, widget, event, slide):
+        n = slide.get_slide()
+        if n is not None:
+            self.__arbiter.do_goto_slide(n, local_request=True)
     
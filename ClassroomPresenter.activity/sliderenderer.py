@@ -20,11 +20,132 @@
 import cairo
 import rsvg
 import gtk
+import gobject
 import os
 import utils
 import time
 import logging
 
+# Memory (in MB) that rendered slides may take up before the least recently shown are dropped
+RENDER_CACHE_MB = 24
+
+# Memory (in MB) for layer files kept loaded (parsed SVGs, decoded PNGs and JPGs)
+LAYER_CACHE_MB = 32
+
+# Memory (in MB) for thumbnails loaded from their PNG files
+THUMB_CACHE_MB = 4
+
+# A parsed SVG takes up more memory than its file; this is a rough guess at how much more
+SVG_SIZE_FACTOR = 4
+
+# Size given to a slide with no size in the deck and no layers to take it from
+DEFAULT_SLIDE_SIZE = [640.0, 480.0]
+
+# Without a thumbnail to go on, a preview is rendered at this fraction of the full size
+PREVIEW_FRACTION = 0.25
+
+def read_layer(filename):
+	"""Loads a layer file, returning (file type, loaded layer, width, height, bytes of memory
+	taken), where the loaded layer is an rsvg.Handle, cairo.ImageSurface or gtk.gdk.Pixbuf
+	for svg, png and jpg files; or None for a file of another type"""
+	ftype = utils.getFileType(filename)
+	if ftype == "svg":
+		f = open(filename, 'rb')
+		svg_data = f.read()
+		f.close()
+		handle = rsvg.Handle(data=svg_data)
+		a, b, w, h = handle.get_dimension_data()
+		return (ftype, handle, w, h, len(svg_data) * SVG_SIZE_FACTOR)
+	elif ftype == "png":
+		surface = cairo.ImageSurface.create_from_png(filename)
+		return (ftype, surface, float(surface.get_width()), float(surface.get_height()),
+			surface.get_stride() * surface.get_height())
+	elif ftype == "jpg":
+		pbuf = gtk.gdk.pixbuf_new_from_file(filename)
+		return (ftype, pbuf, float(pbuf.get_width()), float(pbuf.get_height()),
+			pbuf.get_rowstride() * pbuf.get_height())
+	return None
+
+def open_layer(filename):
+	"""Returns (file type, loaded layer, width, height) for a layer file, read afresh
+	each time, or None for a file of another type; for use away from the Renderer and
+	its cache"""
+	loaded = read_layer(filename)
+	if loaded is None:
+		return None
+	return loaded[:4]
+
+def slide_size(layers, dims=None, load_layer=open_layer):
+	"""Returns the [width, height] of a slide: dims, the size stored in the deck, if it
+	is known; otherwise the size of the first layer, loaded with load_layer"""
+	if dims:
+		return dims
+	if len(layers) > 0:
+		first = load_layer(layers[0])
+		if first is not None:
+			return [first[2], first[3]]
+	# return some default reasonable value if this is an empty slide
+	return DEFAULT_SLIDE_SIZE
+
+def draw_ink_paths(ctx, paths):
+	"""Strokes the ink.Paths onto ctx, which should already have its line cap and join set"""
+	for path in paths:
+		ctx.set_line_width(path.pen)
+		ctx.set_source_rgb(path.color[0], path.color[1], path.color[2])
+		coords = path.coords
+		if len(coords) > 0:
+			ctx.move_to(coords[0], coords[1])
+			for i in xrange(2, len(coords), 2):
+				ctx.line_to(coords[i], coords[i + 1])
+		ctx.stroke()
+
+def draw_slide(surface, srcw, srch, layers, load_layer):
+	"""Draws a slide of size srcw x srch with the given layer files onto surface, scaled
+	to fit.  load_layer(filename) returns (file type, loaded layer, width, height) for a
+	layer, or None to skip it.  Needs no arbiter, deck or display, so it can be used
+	away from the activity (see thumbnailer.py)."""
+	ctx = gtk.gdk.CairoContext(cairo.Context(surface))
+	draw_layers(ctx, surface.get_width(), surface.get_height(), srcw, srch, layers, load_layer)
+
+def draw_layers(ctx, targw, targh, srcw, srch, layers, load_layer):
+	"""Draws a slide of size srcw x srch onto the gtk.gdk.CairoContext ctx, scaled to fit
+	targw x targh, as draw_slide does; for surfaces without a size in pixels, such as
+	the pages of a PDF (see export.py).  Leaves the scaling on ctx."""
+	# Set up a Cairo transformation matrix
+	targw = float(targw)
+	targh = float(targh)
+	x_scale = targw/srcw
+	y_scale = targh/srch
+	
+	scale = x_scale
+	if y_scale < x_scale:
+		scale = y_scale
+	
+	if scale < .98 or scale > 1.02:
+		ctx.transform(cairo.Matrix(scale, 0, 0, scale, 0, 0))
+	
+	# Paint the slide background
+	ctx.set_source_rgb(1.0, 1.0, 1.0)
+	ctx.rectangle(0, 0, srcw, srch)
+	ctx.fill()
+	
+	# Paint the layers
+	for layer in layers:
+		loaded = load_layer(layer)
+		if loaded is None:
+			continue
+		type, data, w, h = loaded
+		if type == "svg":
+			data.render_cairo(ctx)
+		elif type == "png":
+			ctx.set_source_surface(data, 0, 0)
+			ctx.rectangle(0, 0, data.get_width(), data.get_height())
+			ctx.fill()
+		elif type == "jpg":
+			ctx.set_source_pixbuf(data, 0, 0)
+			ctx.rectangle(0, 0, data.get_width(), data.get_height())
+			ctx.fill()
+
 class Renderer(object):
 	def __init__(self, arbiter):
 		"""Constructs a new SlideRenderer that will render slides from deck"""
@@ -32,36 +153,194 @@ class Renderer(object):
 
 		self.__logger = logging.getLogger('Renderer')
 		self.__logger.setLevel(logging.DEBUG)
+		
+		# (slide index, width, height, layers) -> rendered cairo.ImageSurface
+		self.__surface_cache = utils.LRUCache(RENDER_CACHE_MB * 1024 * 1024)
+		# (layer path, mtime) -> (file type, rsvg.Handle/cairo.ImageSurface/gtk.gdk.Pixbuf, width, height)
+		self.__layer_cache = utils.LRUCache(LAYER_CACHE_MB * 1024 * 1024)
+		# (thumbnail path, mtime) -> cairo.ImageSurface
+		self.__thumb_cache = utils.LRUCache(THUMB_CACHE_MB * 1024 * 1024)
+		# seconds taken by the last preview and the last full render
+		self.__timings = {'preview' : None, 'full' : None}
+		self.__arbiter.connect_deck_changed(self.deck_changed_cb)
+	
+	def get_render_timings(self):
+		"""Returns a dict of how long (in seconds) the last 'preview' and the last 'full'
+		render took; None for one that hasn't happened yet"""
+		return self.__timings.copy()
+	
+	def set_cache_budget(self, megabytes):
+		"""Sets how much memory rendered slides may be cached in"""
+		self.__surface_cache.set_budget(megabytes * 1024 * 1024)
+	
+	def set_layer_cache_budget(self, megabytes):
+		"""Sets how much memory loaded layer files may be cached in"""
+		self.__layer_cache.set_budget(megabytes * 1024 * 1024)
+	
+	def set_thumbnail_cache_budget(self, megabytes):
+		"""Sets how much memory loaded thumbnails may be cached in"""
+		self.__thumb_cache.set_budget(megabytes * 1024 * 1024)
+	
+	def deck_changed_cb(self, widget):
+		self.__surface_cache.clear()
+		self.__layer_cache.clear()
+		self.__thumb_cache.clear()
+	
+	def get_thumbnail(self, n):
+		"""Returns the thumbnail of slide n as a cairo.ImageSurface, or None if it hasn't
+		been drawn yet.  Thumbnails are read from their PNG files and kept in a cache of
+		limited size, so the surface should not be held on to."""
+		thumb = self.__arbiter.get_slide_thumb(n)
+		if not thumb:
+			return None
+		try:
+			mtime = os.stat(thumb).st_mtime
+		except OSError:
+			return None
+		key = (thumb, mtime)
+		surface = self.__thumb_cache.get(key)
+		if surface is None:
+			# forget any copy of the file from before it last changed
+			self.__thumb_cache.discard_if(lambda k: k[0] == thumb)
+			try:
+				surface = cairo.ImageSurface.create_from_png(thumb)
+			except (IOError, MemoryError, cairo.Error), e:
+				# a damaged file; older pycairo reports those as MemoryError.  The
+				# placeholder is shown and the thumbnail drawn again.
+				self.__logger.error("Can't load thumbnail %s: %s", thumb, e)
+				return None
+			self.__thumb_cache.put(key, surface, surface.get_stride() * surface.get_height())
+			stats = self.get_thumbnail_cache_stats()
+			self.__logger.debug("Thumbnail cache holds %d thumbnails in %d bytes; hit rate %.0f%%",
+				stats['count'], stats['size'], 100 * stats['hit_rate'])
+		return surface
+	
+	def get_thumbnail_cache_stats(self):
+		"""Returns a dict of the thumbnail cache's 'hits', 'misses', 'hit_rate' (0 to 1),
+		'count' of thumbnails held and their 'size' in bytes"""
+		cache = self.__thumb_cache
+		lookups = cache.hits + cache.misses
+		hit_rate = 0.0
+		if lookups > 0:
+			hit_rate = float(cache.hits) / lookups
+		return {'hits' : cache.hits, 'misses' : cache.misses, 'hit_rate' : hit_rate,
+			'count' : len(cache), 'size' : cache.get_size()}
+	
+	def load_layer(self, filename):
+		"""Returns (file type, loaded layer, width, height) for a layer file, where the
+		loaded layer is an rsvg.Handle, cairo.ImageSurface or gtk.gdk.Pixbuf for svg, png
+		and jpg files.  Each file is only read again if it changes on disk.  Returns None
+		for a layer that can't be loaded."""
+		try:
+			mtime = os.stat(filename).st_mtime
+		except OSError, e:
+			self.__logger.error("Can't read layer %s: %s", filename, e)
+			return None
+		key = (filename, mtime)
+		layer = self.__layer_cache.get(key)
+		if layer is not None:
+			return layer
+		
+		# forget any copy of the file from before it last changed
+		self.__layer_cache.discard_if(lambda k: k[0] == filename)
+		try:
+			loaded = read_layer(filename)
+		except (IOError, gobject.GError, cairo.Error), e:
+			# a damaged layer is left out rather than stopping the slide from being drawn
+			self.__logger.error("Can't load layer %s: %s", filename, e)
+			return None
+		if loaded is None:
+			return None
+		layer = loaded[:4]
+		size = loaded[4]
+		self.__layer_cache.put(key, layer, size)
+		return layer
+	
+	def get_slide_surface(self, width, height, n=None):
+		"""Returns slide n rendered at width x height.  The surface may be shared with
+		other callers, so it must not be drawn on."""
+		if n is None:
+			n = self.__arbiter.get_slide_index()
+		key = self.__cache_key(width, height, n)
+		surface = self.__surface_cache.get(key)
+		if surface is not None:
+			self.__logger.debug("Slide %d at %dx%d was cached", n, width, height)
+			return surface
+		timerstart = time.time()
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		self.render_slide_to_surface(surface, n)
+		self.__timings['full'] = time.time() - timerstart
+		self.__logger.debug("Full render of slide %d took %f seconds", n, self.__timings['full'])
+		self.__surface_cache.put(key, surface, surface.get_stride() * height)
+		self.__logger.debug("Render cache holds %d slides in %d bytes (%d hits, %d misses)",
+			len(self.__surface_cache), self.__surface_cache.get_size(),
+			self.__surface_cache.hits, self.__surface_cache.misses)
+		return surface
+	
+	def has_slide_surface(self, width, height, n=None):
+		"""Returns True if slide n is cached at width x height"""
+		if n is None:
+			n = self.__arbiter.get_slide_index()
+		return self.__cache_key(width, height, n) in self.__surface_cache
+	
+	def get_slide_preview(self, width, height, n=None):
+		"""Returns a quick, rough rendering of slide n at width x height: its thumbnail
+		scaled up if it has one, otherwise a scaled up render at PREVIEW_FRACTION size"""
+		if n is None:
+			n = self.__arbiter.get_slide_index()
+		timerstart = time.time()
+		small = self.get_thumbnail(n)
+		if small is None:
+			small = cairo.ImageSurface(cairo.FORMAT_ARGB32, max(1, int(width * PREVIEW_FRACTION)),
+				max(1, int(height * PREVIEW_FRACTION)))
+			self.render_slide_to_surface(small, n)
+		surface = self.scale_surface(small, width, height, n)
+		self.__timings['preview'] = time.time() - timerstart
+		self.__logger.debug("Preview of slide %d took %f seconds", n, self.__timings['preview'])
+		return surface
+	
+	def scale_surface(self, surface, width, height, n=None):
+		"""Returns a rendering of slide n at width x height made by scaling surface, a
+		rendering of it at another size; quick, but not sharp"""
+		srcw, srch = self.getSlideDimensions(n)
+		srcw = float(srcw)
+		srch = float(srch)
+		old_scale = min(surface.get_width() / srcw, surface.get_height() / srch)
+		new_scale = min(width / srcw, height / srch)
+		scaled = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		ctx = cairo.Context(scaled)
+		if old_scale > 0:
+			ctx.scale(new_scale / old_scale, new_scale / old_scale)
+			ctx.set_source_surface(surface, 0, 0)
+			ctx.get_source().set_filter(cairo.FILTER_FAST)
+			ctx.paint()
+		return scaled
+	
+	def prefetch_slide(self, width, height, n):
+		"""Renders slide n at width x height into the cache, unless it is there already"""
+		if self.__cache_key(width, height, n) not in self.__surface_cache:
+			self.__logger.debug("Prefetching slide %d at %dx%d", n, width, height)
+			self.get_slide_surface(width, height, n)
+	
+	def __cache_key(self, width, height, n):
+		# the layers and their mtimes are part of the key so a slide whose layers change
+		# is rendered afresh, even when another deck unpacked files of the same names
+		# before the renderer has heard about the new deck
+		layers = []
+		for layer in self.__arbiter.get_slide_layers(n):
+			try:
+				mtime = os.stat(layer).st_mtime
+			except OSError:
+				mtime = None
+			layers.append((layer, mtime))
+		return (n, width, height, tuple(layers))
 
 	def getSlideDimensionsFromFirstLayer(self, n=None):
 		"""Returns the [width, height] of the first slide layer"""
 		if n is None:
 			n = self.__arbiter.get_slide_index()
-		layers = self.__arbiter.get_slide_layers(n)
-		
-		# return some default reasonable value if this is an empty slide
-		if len(layers) == 0:
-			return [640.0, 480.0]
-		
-		ftype = utils.getFileType(layers[0])
-		
-		# This may be optimizable to avoid having to open the first layer to get its size,
-		# or at least keeping it around to re-use it when the slide is first rendered
-		if ftype == "svg":
-			f = open(layers[0], 'rb')
-			svg_data = f.read()
-			f.close()
-			handle = rsvg.Handle(data=svg_data)
-			a, b, w, h = handle.get_dimension_data()
-			return [w,h]
-		elif ftype == "png":
-			surface = cairo.ImageSurface.create_from_png(layers[0])
-			return [float(surface.get_width()), float(surface.get_height())]
-		elif ftype == "jpg":
-			pbuf = gtk.gdk.pixbuf_new_from_file(layers[0])
-			return [float(pbuf.get_width()), float(pbuf.get_height())]
-		else:
-			return [640.0, 480.0]
+		# The layer stays loaded for when the slide is rendered
+		return slide_size(self.__arbiter.get_slide_layers(n), None, self.load_layer)
 	
 	def getSlideDimensions(self, n=None):
 		"""Returns the slide dimensions, using the value in the XML file first, if it exists, and then the size of the first layer"""
@@ -69,73 +348,35 @@ class Renderer(object):
 			n = self.__arbiter.get_slide_index()
 		dims = self.__arbiter.get_slide_dimensions_from_xml(n)
 		if dims == False:
-			return self.getSlideDimensionsFromFirstLayer(n)
+			w, h = self.getSlideDimensionsFromFirstLayer(n)
+			self.__save_slide_info(n, w, h)
+			return [w, h]
 		else:
 			w, h = dims
 			return [w, h]
 	
+	def __save_slide_info(self, n, w, h):
+		"""Stores the size of slide n in the deck, along with the type and digest of each
+		layer, so the layers needn't be opened just to size the slide again"""
+		layers = self.__arbiter.get_slide_layers(n)
+		if len(layers) == 0:
+			return
+		layer_info = []
+		try:
+			for layer in layers:
+				layer_info.append((utils.getFileType(layer), utils.file_digest(layer)))
+		except IOError, e:
+			self.__logger.error("Not saving the size of slide %d: %s", n, e)
+			return
+		self.__logger.debug("Saving size %gx%g of slide %d", w, h, n)
+		self.__arbiter.do_set_slide_info(w, h, layer_info, n)
+	
 	def render_slide_to_surface(self, surface, n=None):
 		if n is None:
 			n = self.__arbiter.get_slide_index()
-			
 		timerstart = time.time()
-			
 		self.__logger.debug("rendering slide " + str(n))
-		ctx = gtk.gdk.CairoContext(cairo.Context(surface))
-		#ctx = cairo.Context(surface)
-		
-		self.__logger.debug("Got context at " + str(time.time() - timerstart))
-		
-		# Get the slide dimensions and set up a Cairo transformation matrix
 		srcw, srch = self.getSlideDimensions(n)
-		targw = float(surface.get_width())
-		targh = float(surface.get_height())
-		x_scale = targw/srcw
-		y_scale = targh/srch
-		
-		self.__logger.debug("Surface is " + str(targw) +  "x" + str(targh)) 
-		
-		scale = x_scale
-		if y_scale < x_scale:
-			scale = y_scale
-		
-		if scale < .98 or scale > 1.02:
-			ctx.transform(cairo.Matrix(scale, 0, 0, scale, 0, 0))
-		
-		self.__logger.debug("Got transformation matrix at " + str(time.time() - timerstart))
-		
-		# Paint the slide background
-		ctx.set_source_rgb(1.0, 1.0, 1.0)
-		ctx.rectangle(0, 0, srcw, srch)
-		ctx.fill()
-		
-		self.__logger.debug("Filled background at " + str(time.time() - timerstart))
-		
-		# Paint the layers
-		layers = self.__arbiter.get_slide_layers(n)
-		self.__logger.debug("Got layers at " + str(time.time() - timerstart))
-		for layer in layers:
-			type = utils.getFileType(layer)
-			self.__logger.debug("Drawing layer " + str(layer) +" " + str(scale) + " at "  + str(time.time() - timerstart))
-			if type == "svg":
-				f = open(layer, "rb")
-				svg_data = f.read()
-				f.close()
-				handle = rsvg.Handle(data=svg_data)
-				handle.render_cairo(ctx)
-			elif type == "png":
-				png_surface = cairo.ImageSurface.create_from_png(layer)
-				self.__logger.debug("Got PNG surface at "+ str(time.time() - timerstart))
-				ctx.set_source_surface(png_surface, 0, 0)
-				ctx.rectangle(0, 0, png_surface.get_width(), png_surface.get_height())
-				ctx.fill()
-			elif type == "jpg":
-				jpg_pixbuf = gtk.gdk.pixbuf_new_from_file(layer)
-				self.__logger.debug("Got JPG pixbuf at "+ str(time.time() - timerstart))
-				ctx.set_source_pixbuf(jpg_pixbuf, 0, 0)
-				ctx.rectangle(0, 0, jpg_pixbuf.get_width(), jpg_pixbuf.get_height())
-				ctx.fill()
-			self.__logger.debug("Finished drawing layer at "+ str(time.time() - timerstart))
-		
-	
-	
+		draw_slide(surface, srcw, srch, self.__arbiter.get_slide_layers(n), self.load_layer)
+		self.__logger.debug("Rendered slide " + str(n) + " at " + str(surface.get_width()) + "x" +
+			str(surface.get_height()) + " in " + str(time.time() - timerstart) + " seconds")
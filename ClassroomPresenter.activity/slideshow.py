@@ -21,8 +21,306 @@
 
 import os
 import xml.dom.minidom
+import xml.parsers.expat
+from xml.sax.saxutils import quoteattr
 import gobject
 import logging
+import random
+import ink
+
+def _get_text(element):
+	"""Returns the value of the first text node under element, or an empty string"""
+	if element.firstChild:
+		return element.firstChild.nodeValue
+	return ""
+
+def _get_paths(element):
+	"""Returns the serialized ink strings of all <path> elements under element"""
+	paths = []
+	for path in element.getElementsByTagName("path"):
+		if path.firstChild:
+			paths.append(path.firstChild.nodeValue)
+	return paths
+
+def _to_unicode(value):
+	"""Returns value as unicode; gtk hands out text as UTF-8 encoded str"""
+	if isinstance(value, str):
+		return value.decode("utf-8")
+	return unicode(value)
+
+def _append_text_element(dom, parent, tag, value):
+	"""Appends a <tag>value</tag> element to parent"""
+	element = dom.createElement(tag)
+	element.appendChild(dom.createTextNode(value))
+	parent.appendChild(element)
+	return element
+
+class Submission(object):
+	"""Ink and text that a student submitted (or the instructor broadcast) for a slide"""
+	
+	def __init__(self, whofrom, paths=None, text=""):
+		self.whofrom = whofrom
+		if paths is None:
+			paths = []
+		self.paths = paths
+		self.text = text
+	
+	def to_element(self, dom):
+		element = dom.createElement("submission")
+		element.setAttribute("from", self.whofrom)
+		for pathstr in self.paths:
+			_append_text_element(dom, element, "path", pathstr)
+		_append_text_element(dom, element, "text", self.text)
+		return element
+
+class SubmissionStore(object):
+	"""The submissions for one slide, keyed by sender.  A sender keeps the display
+	position of their first submission, so a resubmission replaces the old one in
+	place and the indices the sidebar shows stay stable."""
+	
+	def __init__(self):
+		self.__subs = {}
+		self.__names = []
+		self.__positions = {}	# sender -> display index
+	
+	def put(self, sub):
+		"""Stores sub, replacing any earlier submission from the same sender; returns its index"""
+		if sub.whofrom not in self.__subs:
+			self.__positions[sub.whofrom] = len(self.__names)
+			self.__names.append(sub.whofrom)
+		self.__subs[sub.whofrom] = sub
+		return self.__positions[sub.whofrom]
+	
+	def get(self, i):
+		"""Returns the submission at display index i, or None"""
+		if i >= 0 and i < len(self.__names):
+			return self.__subs[self.__names[i]]
+		return None
+	
+	def names(self):
+		"""Returns the senders in display order (do not modify the list)"""
+		return self.__names
+	
+	def __iter__(self):
+		for name in self.__names:
+			yield self.__subs[name]
+	
+	def __len__(self):
+		return len(self.__names)
+
+class Slide(object):
+	"""In-memory model of a single <slide> element.  The instructor ink, the local
+	(self) ink and the submissions are kept in indexed containers so that the Deck never
+	has to walk the DOM once a deck has been loaded; the DOM is only rebuilt at save time.
+	
+	The header (attributes, layers, thumbnail and the names of the submitters) is
+	always resident.  The body (all of
+	the ink) of a slide that is backed by deck.xml is only read in on demand; offset and
+	end locate the <slide> element in the file so the body can be re-read after unload()."""
+	
+	def __init__(self, offset=None, end=None):
+		self.attributes = {}
+		self.layers = []
+		self.layer_attributes = []	# attributes of each <layer> element, parallel to layers
+		self.thumb = None
+		self.submitters = []
+		self.offset = offset
+		self.end = end
+		self.dirty = False
+		self.loaded = False
+		self.unload()
+		self.loaded = offset is None
+	
+	def unload(self):
+		"""Drops the body of the slide; it must be backed by the deck file to be read again"""
+		if self.loaded:
+			self.submitters = list(self.submissions.names())
+		self.instructor = ink.StrokeIndex()
+		self.self_ink = ink.StrokeIndex()
+		self.self_text = ""
+		self.submissions = SubmissionStore()
+		self.extra = []
+		self.loaded = False
+	
+	def read_body(self, element):
+		"""Fills in the ink, text and submissions from a minidom <slide> element"""
+		self.unload()
+		have_instructor = False
+		have_self = False
+		for child in element.childNodes:
+			if child.nodeType != child.ELEMENT_NODE:
+				continue
+			if child.tagName == "layer" or child.tagName == "thumb":
+				continue
+			elif child.tagName == "instructor" and not have_instructor:
+				# Only the first <instructor> element has ever been read
+				have_instructor = True
+				self.instructor = ink.StrokeIndex(_get_paths(child))
+			elif child.tagName == "self" and not have_self:
+				have_self = True
+				self.self_ink = ink.StrokeIndex(_get_paths(child))
+				texts = child.getElementsByTagName("text")
+				if len(texts) > 0:
+					self.self_text = _get_text(texts[0])
+			elif child.tagName == "submission":
+				texts = child.getElementsByTagName("text")
+				text = ""
+				if len(texts) > 0:
+					text = _get_text(texts[0])
+				self.submissions.put(Submission(child.getAttribute("from"),
+												_get_paths(child), text))
+			else:
+				# Keep elements we don't know about so they survive a save
+				self.extra.append(child.toxml())
+		self.loaded = True
+	
+	def to_element(self, dom):
+		"""Builds a minidom <slide> element for this slide"""
+		element = dom.createElement("slide")
+		for name, value in self.attributes.items():
+			element.setAttribute(name, value)
+		for i in range(len(self.layers)):
+			layer = _append_text_element(dom, element, "layer", self.layers[i])
+			if i < len(self.layer_attributes):
+				for name, value in self.layer_attributes[i].items():
+					layer.setAttribute(name, value)
+		if self.thumb:
+			_append_text_element(dom, element, "thumb", self.thumb)
+		for extra in self.extra:
+			element.appendChild(xml.dom.minidom.parseString(extra).documentElement)
+		if len(self.instructor) > 0:
+			instr = dom.createElement("instructor")
+			for pathstr in self.instructor:
+				_append_text_element(dom, instr, "path", pathstr)
+			element.appendChild(instr)
+		if len(self.self_ink) > 0 or self.self_text:
+			selftag = dom.createElement("self")
+			for pathstr in self.self_ink:
+				_append_text_element(dom, selftag, "path", pathstr)
+			_append_text_element(dom, selftag, "text", self.self_text)
+			element.appendChild(selftag)
+		for sub in self.submissions:
+			element.appendChild(sub.to_element(dom))
+		return element
+
+class _DeckScanner(object):
+	"""Indexes deck.xml in a single streaming pass with expat.  Only the deck attributes
+	and the slide headers (attributes, layers, thumbnail, submitters) are kept, along
+	with the byte range of every <slide> element; the ink is skipped without building
+	any tree."""
+	
+	def __init__(self):
+		self.have_deck = False
+		self.deck_attributes = {}
+		self.slides = []
+		self.__depth = 0
+		self.__slide = None
+		self.__text = None
+		self.__attrs = None
+		self.__parser = xml.parsers.expat.ParserCreate()
+		self.__parser.StartElementHandler = self.__start
+		self.__parser.EndElementHandler = self.__end
+	
+	def scan(self, path):
+		f = open(path, "rb")
+		try:
+			self.__parser.ParseFile(f)
+		finally:
+			f.close()
+	
+	def __collect(self, data):
+		self.__text.append(data)
+	
+	def __start(self, name, attrs):
+		self.__depth = self.__depth + 1
+		if self.__depth == 1 and name == "deck":
+			self.have_deck = True
+			self.deck_attributes = attrs
+		elif self.__depth == 2 and self.have_deck and name == "slide":
+			self.__slide = Slide(offset=self.__parser.CurrentByteIndex)
+			self.__slide.attributes = attrs
+		elif self.__depth == 3 and self.__slide and name == "submission":
+			whofrom = attrs.get("from", "")
+			if whofrom not in self.__slide.submitters:
+				self.__slide.submitters.append(whofrom)
+		elif self.__depth == 3 and self.__slide and (name == "layer" or name == "thumb"):
+			# Character data is only collected for these; the ink is never seen by Python
+			self.__text = []
+			self.__attrs = attrs
+			self.__parser.CharacterDataHandler = self.__collect
+	
+	def __end(self, name):
+		if self.__depth == 2 and self.__slide:
+			# This is the index of the start of the end tag, or just past an empty <slide/>
+			self.__slide.end = self.__parser.CurrentByteIndex
+			self.slides.append(self.__slide)
+			self.__slide = None
+		elif self.__depth == 3 and self.__text is not None:
+			value = "".join(self.__text)
+			if name == "layer":
+				if value:
+					self.__slide.layers.append(value)
+					self.__slide.layer_attributes.append(self.__attrs)
+			elif value and not self.__slide.thumb:
+				self.__slide.thumb = value
+			self.__text = None
+			self.__parser.CharacterDataHandler = None
+		self.__depth = self.__depth - 1
+
+class _Journal(object):
+	"""Append-only log of the changes made to a deck since deck.xml was last written.
+	Each record is one line of tab-separated, string_escape'd fields.  The first line
+	holds the token of the deck.xml the records apply to, so that a journal left over
+	from another deck (or from before a compaction) is never replayed."""
+	
+	def __init__(self, path):
+		self.__path = path
+		self.__file = None
+	
+	def append(self, token, fields):
+		if self.__file is None:
+			self.__file = open(self.__path, "ab")
+			if self.__file.tell() == 0:
+				self.__file.write("journal\t" + token + "\n")
+		line = []
+		for field in fields:
+			line.append(_to_unicode(field).encode("utf-8").encode("string_escape"))
+		self.__file.write("\t".join(line) + "\n")
+		self.__file.flush()
+	
+	def sync(self):
+		"""Makes sure every record appended so far is on disk"""
+		if self.__file:
+			self.__file.flush()
+			os.fsync(self.__file.fileno())
+	
+	def records(self, token):
+		"""Returns the records in the journal as lists of unicode fields, or an empty list if
+		the journal does not belong to the deck with the given token"""
+		if not os.path.exists(self.__path):
+			return []
+		f = open(self.__path, "rb")
+		try:
+			lines = f.read().split("\n")
+		finally:
+			f.close()
+		if lines[0] != "journal\t" + token:
+			return []
+		records = []
+		# The last element is either empty or a record cut short by a crash
+		for line in lines[1:-1]:
+			fields = []
+			for field in line.split("\t"):
+				fields.append(field.decode("string_escape").decode("utf-8"))
+			records.append(fields)
+		return records
+	
+	def clear(self):
+		if self.__file:
+			self.__file.close()
+			self.__file = None
+		if os.path.exists(self.__path):
+			os.remove(self.__path)
 
 class Deck(gobject.GObject):
 	
@@ -41,102 +339,240 @@ class Deck(gobject.GObject):
 		'instructor-ink-removed' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_INT, gobject.TYPE_INT)),
 	}
 	
-	def __init__(self, arbiter, base="/nfs/show"):
+	def __init__(self, arbiter, base="/nfs/show", layer_digests=None):
 		gobject.GObject.__init__(self)
 		
 		self.__arbiter = arbiter
 		self.__base = base
+		if layer_digests is None:
+			layer_digests = {}
+		self.__layer_digests = layer_digests
+		self.__stale_info = {}
 
 		self.__logger = logging.getLogger('Deck')
 		self.__logger.setLevel(logging.DEBUG)
 
 		self.__active_sub = -1
-		self.__self_text = ""
-		self.__text_tag = None
+		
+		# Changes to the deck are appended to the journal; deck.xml itself is only
+		# rewritten by save()
+		self.__journal = _Journal(os.path.join(base, "deck.journal"))
+		self.__replaying = False
 		
 		# Compute the path to the deck.xml file and read it if it exists;
-		# otherwise we'll create a new XML Document
+		# otherwise we'll create a new, single-slide deck
 		self.__xmlpath = os.path.join(base, "deck.xml")
 		self.reload()
 			
 	def reload(self):
 		self.__logger.debug("Reading deck")
+		scanner = _DeckScanner()
 		if os.path.exists(self.__xmlpath):
-			self.__dom = xml.dom.minidom.parse(self.__xmlpath)
-		else:
-			self.__dom = xml.dom.minidom.Document()
+			scanner.scan(self.__xmlpath)
+		self.__deck_attributes = scanner.deck_attributes
+		self.__slides = scanner.slides
+		self.__resident = {}
 
-		# Look for the root deck element; create it if it's not there
-		decks = self.__dom.getElementsByTagName("deck")
-		if len(decks) > 0:
-			self.__deck = decks[0]
-		else:
-			self.__deck = self.__dom.createElement("deck")
-			self.__dom.appendChild(self.__deck)
-			splash = self.__dom.createElement("slide")
-			layer = self.__dom.createElement("layer")
-			layer.appendChild(self.__dom.createTextNode("splash.svg"))
-			splash.appendChild(layer)
-			self.__deck.appendChild(splash)
+		# Look for the root deck element; show the splash screen if it's not there
+		if not scanner.have_deck:
+			splash = Slide()
+			splash.layers.append("splash.svg")
+			self.__slides.append(splash)
 
-		# Get the slides from the show
-		self.__slides = self.__deck.getElementsByTagName("slide")
 		self.__nslides = len(self.__slides)
 		self.__logger.debug(str(self.__nslides) + " slides in show")
+		self.__pos = 0
+		self.__replay_journal()
+		self.__find_stale_info()
 		self.goto_slide(0, local_request=True)
 		self.emit("deck-changed")
 	
+	def set_layer_digests(self, digests):
+		"""Gives the SHA-1 digests of the deck's files (name -> hex digest), worked out as
+		they were unpacked.  The next reload() ignores the stored size of any slide whose
+		layers don't match the digests stored with it, so that size is worked out afresh."""
+		self.__layer_digests = digests
+	
+	def __find_stale_info(self):
+		"""Finds the slides whose stored size was recorded for other layer files.  Nothing
+		is hashed here; only the digests given to set_layer_digests are compared."""
+		self.__stale_info = {}
+		for n in range(self.__nslides):
+			slide = self.__slides[n]
+			for i in range(min(len(slide.layers), len(slide.layer_attributes))):
+				digest = slide.layer_attributes[i].get("sha1")
+				actual = self.__layer_digests.get(slide.layers[i])
+				if digest and actual and digest != actual:
+					self.__logger.debug("Layers of slide %d changed since its size was stored", n)
+					self.__stale_info[n] = True
+					break
+	
+	def __replay_journal(self):
+		"""Re-applies the changes recorded in the journal since deck.xml was written"""
+		token = self.__deck_attributes.get("journal")
+		if not token:
+			self.__journal.clear()
+			return
+		records = self.__journal.records(token)
+		if len(records) == 0:
+			self.__journal.clear()
+			return
+		self.__logger.debug("Replaying " + str(len(records)) + " journal records")
+		self.__replaying = True
+		try:
+			for fields in records:
+				try:
+					op = fields[0]
+					n = int(fields[1])
+					if op == "add":
+						self.__add_path(n, fields[2], fields[3])
+					elif op == "remove":
+						self.__remove_paths(n, fields[2], int(fields[3]))
+					elif op == "clear":
+						self.__clear_paths(n, fields[2])
+					elif op == "submission":
+						self.__put_submission(n, fields[2], fields[3], fields[4])
+					elif op == "text":
+						self.__set_text(n, fields[2])
+					elif op == "thumb":
+						self.__set_thumb(n, fields[2])
+					elif op == "info":
+						self.__set_info(n, fields[2], fields[3], zip(fields[4::2], fields[5::2]))
+				except (IndexError, ValueError), e:
+					self.__logger.error("Skipping bad journal record: %s", e)
+		finally:
+			self.__replaying = False
+	
+	def flush(self):
+		"""Makes the current state of the deck durable.  Normally this only syncs the journal;
+		the deck is written out in full if there is no deck.xml for the journal to apply to."""
+		if self.__deck_attributes.get("journal") and os.path.exists(self.__xmlpath):
+			self.__journal.sync()
+		else:
+			self.save()
+	
 	def save(self, path=None):
-		"""Writes the XML DOM in memory out to disk"""
+		"""Writes the slide model in memory out to disk as XML.  Slides whose ink was never
+		read in are copied straight across from the current deck file.  Saving over deck.xml
+		compacts the journal into it."""
 		if not path:
 			path = self.__xmlpath
-		outfile = open(path, "w")
-		self.__dom.writexml(outfile)
-		outfile.close()
+		same_file = os.path.abspath(path) == os.path.abspath(self.__xmlpath)
+		if same_file:
+			self.__deck_attributes["journal"] = "%08x" % random.getrandbits(32)
+		tmppath = path + ".tmp"
+		infile = None
+		if os.path.exists(self.__xmlpath):
+			infile = open(self.__xmlpath, "rb")
+		outfile = open(tmppath, "wb")
+		try:
+			outfile.write('<?xml version="1.0" encoding="utf-8"?>')
+			attrs = ""
+			for name, value in self.__deck_attributes.items():
+				attrs = attrs + " " + name + "=" + quoteattr(value)
+			outfile.write(("<deck" + attrs + ">").encode("utf-8"))
+			dom = xml.dom.minidom.Document()
+			offsets = []
+			for slide in self.__slides:
+				if slide.loaded:
+					data = slide.to_element(dom).toxml().encode("utf-8")
+				elif slide.dirty:
+					# Only the header changed; pull in the body just long enough to write it
+					slide.read_body(self.__parse_slide(slide, infile))
+					data = slide.to_element(dom).toxml().encode("utf-8")
+					slide.unload()
+				else:
+					data = self.__read_slide(slide, infile)
+				offset = outfile.tell()
+				if data.endswith("</slide>"):
+					offsets.append((offset, offset + len(data) - len("</slide>")))
+				else:
+					offsets.append((offset, offset + len(data)))
+				outfile.write(data)
+			outfile.write("</deck>")
+		finally:
+			outfile.close()
+			if infile:
+				infile.close()
+		os.rename(tmppath, path)
+		if same_file:
+			self.__journal.clear()
+			for i in range(self.__nslides):
+				slide = self.__slides[i]
+				slide.offset, slide.end = offsets[i]
+				slide.dirty = False
+			self.__evict()
+	
+	def __read_slide(self, slide, f):
+		"""Returns the raw bytes of the <slide> element for slide from the deck file f"""
+		f.seek(slide.offset)
+		data = f.read(slide.end - slide.offset + 64)
+		end = slide.end - slide.offset
+		if data.startswith("</slide", end):
+			return data[:data.find(">", end) + 1]
+		# An empty <slide/> element; end is just past it
+		return data[:end]
+	
+	def __parse_slide(self, slide, f):
+		return xml.dom.minidom.parseString(self.__read_slide(slide, f)).documentElement
+	
+	def __load(self, n):
+		"""Returns slide n, reading its ink in from the deck file if it isn't resident"""
+		slide = self.__slides[n]
+		if not slide.loaded:
+			f = open(self.__xmlpath, "rb")
+			try:
+				element = self.__parse_slide(slide, f)
+			finally:
+				f.close()
+			slide.read_body(element)
+			element.unlink()
+			self.__resident[n] = True
+		return slide
+	
+	def __touch(self, n):
+		"""Returns slide n, marking it as modified so it is kept resident until the next save"""
+		slide = self.__load(n)
+		slide.dirty = True
+		return slide
+	
+	def __evict(self):
+		"""Drops the ink of unmodified slides that are not the current slide or its neighbours"""
+		for n in self.__resident.keys():
+			slide = self.__slides[n]
+			if (n < self.__pos - 1 or n > self.__pos + 1) and not slide.dirty and slide.offset is not None:
+				slide.unload()
+				del self.__resident[n]
 	
 	def get_deck_path(self):
 		"""Returns the path to the folder that stores this slide deck"""
 		return self.__base
 	
+	def __get_index(self, n):
+		"""Returns n, or the current slide index if n is None or out of range"""
+		if n is not None and n >= 0 and n < self.__nslides:
+			return n
+		return self.__pos
+	
 	def get_slide_layers(self, n=-1):
 		"""Returns a list of the layers that comprise this slide"""
 		if n == -1:
 			n = self.__pos
 		slide = self.__slides[n]
-		self.__layers = slide.getElementsByTagName("layer")
 		layers = []
-		for l in self.__layers:
-			p = os.path.join(self.__base, l.firstChild.nodeValue)
-			layers.append(p)
+		for l in slide.layers:
+			layers.append(os.path.join(self.__base, l))
 		return layers
 	
 	def get_instructor_ink(self):
-		self.__instructor_ink = []
-		instr = self.__slide.getElementsByTagName("instructor")
-		if len(instr) > 0:
-			self.__instructor_tag = instr[0]
-			pathtags = self.__instructor_tag.getElementsByTagName("path")
-			for pathstr in pathtags:
-				self.__instructor_ink.append(pathstr.firstChild.nodeValue)
-		return self.__instructor_ink
+		return list(self.__slide.instructor)
 		
 	def get_self_ink_or_submission(self):
 		if self.__active_sub == -1:
-			return (self.__self_ink, self.__self_text)
-		subtags = self.__slide.getElementsByTagName("submission")
-		if self.__active_sub > -1 and self.__active_sub < len(subtags):
-			active_subtag = subtags[self.__active_sub]
-			text = ""
-			texts = active_subtag.getElementsByTagName("text")
-			if len(texts) > 0:
-				if texts[0].firstChild:
-					text = texts[0].firstChild.nodeValue
-			pathlist = []
-			paths = active_subtag.getElementsByTagName("path")
-			for path in paths:
-				if path.firstChild:
-					pathlist.append(path.firstChild.nodeValue)
-			return (pathlist, text)
+			return (list(self.__slide.self_ink), self.__slide.self_text)
+		sub = self.__slide.submissions.get(self.__active_sub)
+		if sub:
+			return (sub.paths, sub.text)
 		return None
 	
 	def set_active_submission(self, sub):
@@ -147,75 +583,32 @@ class Deck(gobject.GObject):
 		return self.__active_sub
 	
 	def get_submission_list(self, n=None):
-		if n is None:
-			n = self.__pos
-		subtags = self.__slide.getElementsByTagName("submission")
-		sublist = []
-		for subtag in subtags:
-			sublist.append(subtag.getAttribute("from"))
-		return sublist
+		slide = self.__slides[self.__get_index(n)]
+		if slide.loaded:
+			return list(slide.submissions.names())
+		# The scan of deck.xml already found who submitted; no need to read the ink
+		return list(slide.submitters)
 	
 	def add_submission(self, whofrom, inks, text="", n=None):
 		if n is None:
 			n = self.__pos
-		if n >= 0 and n < self.get_slide_count():
-			slide = self.__slides[n]
-		else:
-			slide = self.__slides[self.__pos]
-		newsub = self.__dom.createElement("submission")
-		newsub.setAttribute("from", whofrom)
-		substrparts = inks.split("$")
-		for part in substrparts:
-			if len(part) > 0:
-				newpath = self.__dom.createElement("path")
-				newpath.appendChild(self.__dom.createTextNode(part))
-				newsub.appendChild(newpath)
-		subtext = self.__dom.createElement("text")
-		subtext.appendChild(self.__dom.createTextNode(text))
-		newsub.appendChild(subtext)
-		subs = slide.getElementsByTagName("submission")
-		for sub in subs:
-			if sub.getAttribute("from") == whofrom:
-				slide.removeChild(sub)
-		slide.appendChild(newsub)
-		subs = slide.getElementsByTagName("submission")
+		index = self.__put_submission(self.__get_index(n), whofrom, inks, text)
 		if n == self.__pos:
-			self.emit('update-submissions', len(subs) - 1)
+			self.emit('update-submissions', index)
 	
 	def add_ink_to_slide(self, pathstr, islocal, n=None):
 		"""Adds ink to the current slide, or slide n if given.  Instructor ink may be added to any slide;
 		but it only makes sense to add student ink to the current slide (n will be ignored)"""
-		if n is None:
-			slide = self.__slide
-			instr_tag = self.__instructor_tag
-			if instr_tag == None:
-				instr_tag = self.__dom.createElement("instructor")
-				slide.appendChild(instr_tag)
-				self.__instructor_tag = instr_tag
-		else:
-			if n < self.get_slide_count() and n >= 0:
-				slide = self.__slides[n]
-			else:
-				slide = self.__slides[self.__pos]
-			instr_tags = slide.getElementsByTagName("instructor")
-			if len(instr_tags) > 0:
-				instr_tag = instr_tags[0]
-			else:
-				instr_tag = self.__dom.createElement("instructor")
-				slide.appendChild(instr_tag)
+		if not islocal:
+			# The instructor's pen-up may reach us more than once; keep the first copy
+			uid = ink.parse_uid(pathstr)
+			if uid != 0 and self.__load(self.__get_index(n)).instructor.has_uid(uid):
+				self.__logger.debug("Ignoring repeated instructor path %d", uid)
+				return
 		if not islocal or self.__arbiter.get_is_instructor():
-			self.__instructor_ink.append(pathstr)
-			path = self.__dom.createElement("path")
-			path.appendChild(self.__dom.createTextNode(pathstr))
-			instr_tag.appendChild(path)
+			self.__add_path(self.__get_index(n), "instructor", pathstr)
 		else:
-			self.__self_ink.append(pathstr)
-			if not self.__self_ink_tag:
-				self.__self_ink_tag = self.__dom.createElement("self")
-				self.__slide.appendChild(self.__self_ink_tag)
-			path = self.__dom.createElement("path")
-			path.appendChild(self.__dom.createTextNode(pathstr))
-			self.__self_ink_tag.appendChild(path)
+			self.__add_path(self.__pos, "self_ink", pathstr)
 		if islocal:
 			self.emit("local-ink-added", pathstr)
 		else:
@@ -225,77 +618,96 @@ class Deck(gobject.GObject):
 	def clear_ink(self, n=None):
 		if n is None:
 			n = self.__pos
-		slide = self.__slides[n]
 		if self.__arbiter.get_is_instructor():
 			self.clear_instructor_ink(n)
 			self.emit('instructor-ink-cleared', n)
-		self_tags = slide.getElementsByTagName("self")
-		for self_tag in self_tags:
-			slide.removeChild(self_tag)
-		self.__self_ink = []
-		self.__self_ink_tag = None
+		self.__clear_paths(n, "self_ink")
 	
 	def clear_instructor_ink(self, n=None):
 		if n is None:
 			n = self.__pos
-		slide = self.__slides[n]
-		instructor_tags = slide.getElementsByTagName("instructor")
-		for instructor_tag in instructor_tags:
-			slide.removeChild(instructor_tag)
+		self.__clear_paths(n, "instructor")
 		if n == self.__pos:
-			self.__instructor_ink = []
-			self.__instructor_tag = None
 			self.emit('slide-redraw')
 	
 	def remove_instructor_path_by_uid(self, uid, n=None):
 		if n is None:
 			n = self.__pos
-		needs_redraw = False
-		slide = self.__slides[n]
-		instructor_tags = slide.getElementsByTagName("instructor")
-		if len(instructor_tags) > 0:
-			instructor_tag = instructor_tags[0]
-		else:
-			return
-		path_tags = instructor_tag.getElementsByTagName("path")
-		for path_tag in path_tags:
-			if path_tag.firstChild:
-				pathstr = path_tag.firstChild.nodeValue
-				path_uid = 0
-				try:
-					path_uid = int(pathstr[0:pathstr.find(';')]) 
-				except Exception, e:
-					pass
-				if path_uid == uid:
-					instructor_tag.removeChild(path_tag)
-					needs_redraw = True
+		needs_redraw = self.__remove_paths(n, "instructor", uid)
 		if n == self.__pos and needs_redraw:
 			self.emit('remove-path', uid)
 	
 	def remove_local_path_by_uid(self, uid, n=None):
 		if n is None:
 			n = self.__pos
-		slide = self.__slides[n]
 		if self.__arbiter.get_is_instructor():
 			self.emit('instructor_ink_removed', uid, n)
-			tags = slide.getElementsByTagName("instructor")
-		else:
-			tags = slide.getElementsByTagName("self")
-		if len(tags) > 0:
-			tag = tags[0]
+			self.__remove_paths(n, "instructor", uid)
 		else:
+			self.__remove_paths(n, "self_ink", uid)
+	
+	# The methods below are the only ones that change the slide model.  Each records
+	# the change in the journal before making it, so replaying the journal on reload
+	# goes through exactly the same code.  kind is "instructor" or "self_ink".
+	
+	def __log(self, *fields):
+		if self.__replaying:
 			return
-		path_tags = tag.getElementsByTagName("path")
-		for path_tag in path_tags:
-			if path_tag.firstChild:
-				pathstr = path_tag.firstChild.nodeValue
-				path_uid = 0
-				try:
-					path_uid = int(pathstr[0:pathstr.find(';')]) 
-				except Exception, e:
-					pass
-				if path_uid == uid:
-					tag.removeChild(path_tag)
+		if not self.__deck_attributes.get("journal") or not os.path.exists(self.__xmlpath):
+			# The journal needs a deck.xml to apply to
+			self.save()
+		self.__journal.append(self.__deck_attributes["journal"], fields)
+	
+	def __add_path(self, n, kind, pathstr):
+		self.__log("add", n, kind, pathstr)
+		getattr(self.__touch(n), kind).append(pathstr)
+	
+	def __remove_paths(self, n, kind, uid):
+		"""Removes every path with the given uid; returns True if any were removed"""
+		self.__log("remove", n, kind, uid)
+		return len(getattr(self.__touch(n), kind).remove_uid(uid)) > 0
+	
+	def __clear_paths(self, n, kind):
+		self.__log("clear", n, kind)
+		setattr(self.__touch(n), kind, ink.StrokeIndex())
+	
+	def __put_submission(self, n, whofrom, inks, text):
+		"""Stores a submission, replacing any earlier one from whofrom; returns its index"""
+		self.__log("submission", n, whofrom, inks, text)
+		paths = []
+		for part in inks.split("$"):
+			if len(part) > 0:
+				paths.append(part)
+		return self.__touch(n).submissions.put(Submission(whofrom, paths, text))
+	
+	def __set_text(self, n, textval):
+		# kept as unicode, so it can be joined with the rest of the slide when it is saved
+		textval = _to_unicode(textval)
+		self.__log("text", n, textval)
+		self.__touch(n).self_text = textval
+	
+	def __set_thumb(self, n, filename):
+		self.__log("thumb", n, filename)
+		slide = self.__slides[n]
+		slide.thumb = filename
+		slide.dirty = True
+	
+	def __set_info(self, n, width, height, layer_info):
+		fields = ["info", n, width, height]
+		for ftype, digest in layer_info:
+			fields.extend([ftype, digest])
+		self.__log(*fields)
+		slide = self.__slides[n]
+		slide.attributes["width"] = width
+		slide.attributes["height"] = height
+		for i in range(min(len(slide.layers), len(layer_info))):
+			while len(slide.layer_attributes) <= i:
+				slide.layer_attributes.append({})
+			ftype, digest = layer_info[i]
+			slide.layer_attributes[i]["type"] = ftype
+			slide.layer_attributes[i]["sha1"] = digest
+		self.__stale_info.pop(n, None)
+		slide.dirty = True
 						
 	def submit_ink(self):
 		inks, text, whofrom = self.getSerializedInkSubmission()
@@ -307,99 +719,52 @@ class Deck(gobject.GObject):
 		self.emit('ink-broadcast', whofrom, inks, text)
 	
 	def getSerializedInkSubmission(self):
-		sub = ""
-		text = ""
 		if self.__active_sub == -1:
-			self_tags = self.__slide.getElementsByTagName("self")
-			if len(self_tags) > 0:
-				texts = self_tags[0].getElementsByTagName("text")
-				if len(texts) > 0:
-					if texts[0].firstChild:
-						text = texts[0].firstChild.nodeValue
-				for path in self_tags[0].getElementsByTagName("path"):
-					sub = sub + path.firstChild.nodeValue + "$"
-			return sub, text, "myself"
+			paths = self.__slide.self_ink
+			text = self.__slide.self_text
+			whofrom = "myself"
 		else:
-			sub = ""
+			paths = []
+			text = ""
 			whofrom = "unknown"
-			subtags = self.__slide.getElementsByTagName("submission")
-			if self.__active_sub > -1 and self.__active_sub < len(subtags):
-				active_subtag = subtags[self.__active_sub]
-				text = ""
-				whofrom = active_subtag.getAttribute("from")
-				texts = active_subtag.getElementsByTagName("text")
-				if len(texts) > 0:
-					if texts[0].firstChild:
-						text = texts[0].firstChild.nodeValue
-				pathlist = []
-				paths = active_subtag.getElementsByTagName("path")
-				for path in paths:
-					if path.firstChild:
-						sub = sub + path.firstChild.nodeValue + "$"
-			return sub, text, whofrom
+			sub = self.__slide.submissions.get(self.__active_sub)
+			if sub:
+				paths = sub.paths
+				text = sub.text
+				whofrom = sub.whofrom
+		sub = "".join([pathstr + "$" for pathstr in paths])
+		return sub, text, whofrom
 	
 	def get_slide_thumb(self, n=-1):
 		"""Returns the full path to the thumbnail for this slide if it is defined; otherwise False"""
 		if n == -1:
 			n = self.__pos
 		slide = self.__slides[n]
-		thumbs = slide.getElementsByTagName("thumb")
-		if len(thumbs) < 1:
+		if not slide.thumb:
 			return False
-		return os.path.join(self.__base, thumbs[0].firstChild.nodeValue)
+		return os.path.join(self.__base, slide.thumb)
 	
 	def set_slide_thumb(self, filename, n=-1):
 		"""Sets the thumbnail for this slide to filename (provide a *relative* path!)"""
 		if n == -1:
 			n = self.__pos
-		slide = self.__slides[n]
-		thumbs = slide.getElementsByTagName("thumb")
-		for t in thumbs:
-			slide.removeChild(t)
-		thumb = self.__dom.createElement("thumb")
-		thumb.appendChild(self.__dom.createTextNode(filename))
-		slide.appendChild(thumb)
+		self.__set_thumb(n, filename)
+	
+	def set_slide_info(self, width, height, layer_info, n=-1):
+		"""Records the size of slide n, and the file type and SHA-1 digest of each of its
+		layers (as a list of (type, digest) pairs), so that they are saved in the deck"""
+		if n == -1:
+			n = self.__pos
+		self.__set_info(n, "%g" % width, "%g" % height, layer_info)
 	
 	def set_slide_text(self, textval):
-		self.__self_text = textval
-		if self.__text_tag:
-		 	if self.__text_tag.firstChild:
-				self.__text_tag.firstChild.nodeValue = textval
-			else:
-				self.__text_tag.appendChild(self.__dom.createTextNode(textval))
-			
+		self.__set_text(self.__pos, textval)
 		
 	def doNewIndex(self):
 		"""Updates any necessary state associated with moving to a new slide"""
-		self.__slide = self.__slides[self.__pos]
-		self_ink = self.__slide.getElementsByTagName("self")
-		self.__instructor_tag = None
-		self.__self_ink_tag = None
-		self.__instructor_ink = []
-		self.__self_ink = []
-		self.__self_text = ""
-		self.__text_tag = None
+		self.__slide = self.__load(self.__pos)
+		self.__evict()
 		self.__active_sub = -1
-		if len(self_ink) > 0:
-			self.__self_ink_tag = self_ink[0]
-			texttags = self.__self_ink_tag.getElementsByTagName("text")
-			if len(texttags) > 0:
-				self.__text_tag = texttags[0]
-			else:
-				self.__text_tag = self.__dom.createElement("text")
-				self.__text_tag.appendChild(self.__dom.createTextNode(""))
-				self.__self_ink_tag.appendChild(self.__text_tag)
-			pathtags = self.__self_ink_tag.getElementsByTagName("path")
-			for pathstr in pathtags:
-				self.__self_ink.append(pathstr.firstChild.nodeValue)
-		else:
-			self.__self_ink_tag = self.__dom.createElement("self")
-			self.__slide.appendChild(self.__self_ink_tag)
-			self.__text_tag = self.__dom.createElement("text")
-			self.__text_tag.appendChild(self.__dom.createTextNode(""))
-			self.__self_ink_tag.appendChild(self.__text_tag)
-		if self.__text_tag.firstChild:
-			self.__self_text = self.__text_tag.firstChild.nodeValue
 			
 		self.emit("slide-changed")
 		self.emit("update-submissions", self.__active_sub)
@@ -455,9 +820,11 @@ class Deck(gobject.GObject):
 		"""Returns the dimensions for the slide at index n, if they're specified"""
 		if n == -1:
 			n = self.__pos
+		if n in self.__stale_info:
+			return False
 		slide = self.__slides[n]
-		wstring = slide.getAttribute("width")
-		hstring = slide.getAttribute("height")
+		wstring = slide.attributes.get("width", '')
+		hstring = slide.attributes.get("height", '')
 		if wstring != '' and hstring != '':
 			return [float(wstring), float(hstring)]
 		return False
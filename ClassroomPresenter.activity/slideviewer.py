@@ -22,16 +22,75 @@ import rsvg
 import gtk
 import os
 import time
+import math
 import ink
+import inkcodec
+import sliderenderer
 import logging
 import gobject
 
+# Points closer than this many pixels to the simplified stroke are dropped at pen-up
+SIMPLIFY_TOLERANCE = 1.0
+
+# While the instructor draws, the points of the stroke so far are streamed to students
+# at most this often (milliseconds)
+STREAM_INTERVAL = 50
+
+# The slide is only rendered again at a new canvas size once the size has stopped changing
+# for this long (milliseconds); until then the old rendering is shown scaled
+RESIZE_SETTLE_TIME = 200
+
+# Show a slide that isn't rendered yet as a rough preview first, then swap in the full render
+PROGRESSIVE_RENDER = True
+
+class InkLayer(object):
+    """The strokes of one kind of ink shown on the canvas, indexed both by uid and by
+    position.  Iterating gives the strokes in drawing order."""
+
+    def __init__(self):
+        self.__index = ink.StrokeIndex(uid_of=ink.path_uid)
+        self.__grid = ink.StrokeGrid()
+
+    def append(self, path):
+        self.__index.append(path)
+        self.__grid.add(path)
+
+    def update(self, path):
+        """Re-files a stroke in the layer after its points have changed"""
+        self.__grid.update(path)
+
+    def remove(self, path):
+        if self.__index.remove(path):
+            self.__grid.remove(path)
+            return True
+        return False
+
+    def remove_uid(self, uid):
+        removed = self.__index.remove_uid(uid)
+        for path in removed:
+            self.__grid.remove(path)
+        return removed
+
+    def has_uid(self, uid):
+        return self.__index.has_uid(uid)
+
+    def query(self, box):
+        """Returns the strokes overlapping the (x0, y0, x1, y1) box, in drawing order"""
+        return self.__grid.query(box)
+
+    def __iter__(self):
+        return iter(self.__index)
+
+    def __len__(self):
+        return len(self.__index)
+
 class SlideViewer(gtk.EventBox):
     __gsignals__ = {'button_press_event' : 'override',
                     'button_release_event' : 'override',
                     'motion_notify_event' : 'override',
                     'enter_notify_event'    : 'override',
                     'undo-redo-changed' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+                    'ink-streamed' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_STRING,)),
                     }
     
     def __init__(self, arbiter):
@@ -49,6 +108,12 @@ class SlideViewer(gtk.EventBox):
         self.__arbiter.connect_remote_ink_added(self.remote_ink_added)
         self.__arbiter.connect_remove_path(self.instr_remove_ink)
         self.__cur_path = None
+        self.__simplify_tolerance = SIMPLIFY_TOLERANCE
+        self.__points_drawn = 0
+        self.__points_kept = 0
+        self.__stream_interval = STREAM_INTERVAL
+        self.__stream_timer = None
+        self.__streamed = 0
         
         # default color-blue and pen-4
         self.set_pen(4)
@@ -66,6 +131,26 @@ class SlideViewer(gtk.EventBox):
     def get_pen(self):
         return self.__canvas.get_pen()
     
+    def set_simplify_tolerance(self, tolerance):
+        """Sets the stroke simplification tolerance in pixels; 0 keeps every point"""
+        self.__simplify_tolerance = tolerance
+
+    def get_simplify_tolerance(self):
+        return self.__simplify_tolerance
+
+    def get_simplify_ratio(self):
+        """Returns the fraction of drawn points that simplification has kept so far"""
+        if self.__points_drawn == 0:
+            return 1.0
+        return float(self.__points_kept) / self.__points_drawn
+
+    def set_stream_interval(self, interval):
+        """Sets how often (in milliseconds) a stroke in progress is streamed to students"""
+        self.__stream_interval = interval
+
+    def get_stream_interval(self):
+        return self.__stream_interval
+
     def show_current(self, widget):
         """Handle a slide-redraw event by showing the current slide."""
         self.show_slide()
@@ -75,8 +160,12 @@ class SlideViewer(gtk.EventBox):
         self.emit('undo-redo-changed')
         
     def remote_ink_added(self, event, inkstr):
-        self.__canvas.add_ink_path(ink.Path(inkstr), ink_from_instr=True)
-        self.__canvas.queue_draw()
+        self.__canvas.add_finished_ink(ink.Path(inkstr))
+
+    def add_streamed_ink(self, inkstr, n):
+        """Shows part of a stroke the instructor is still drawing on slide n"""
+        if n == self.__arbiter.get_slide_index():
+            self.__canvas.add_streamed_ink(ink.Path(inkstr))
     
     def clear_ink(self):
         if self.__arbiter.get_is_instructor():
@@ -84,20 +173,17 @@ class SlideViewer(gtk.EventBox):
             for path in self.__canvas.instr_ink:
                 pathlist.append(path)
             self.__canvas.undo_stack.append(SlideViewer.EraseAllAction(self, pathlist))
-            self.__canvas.instr_ink = []
+            self.__canvas.instr_ink = InkLayer()
         elif self.__arbiter.get_active_submission() == -1:
             pathlist = []
             for path in self.__canvas.self_ink:
                 pathlist.append(path)
             self.__canvas.undo_stack.append(SlideViewer.EraseAllAction(self, pathlist))
-            self.__canvas.self_ink = []
-        self.__canvas.queue_draw()
+            self.__canvas.self_ink = InkLayer()
+        self.__canvas.ink_removed()
     
     def instr_remove_ink(self, widget, uid):
-        for path in self.__canvas.instr_ink:
-            if path.uid == uid:
-                self.__canvas.instr_ink.remove(path)
-        self.__canvas.queue_draw()
+        self.__canvas.ink_removed(self.__canvas.instr_ink.remove_uid(uid), instructor=True)
     
     def can_undo_redo(self):
         if self.__arbiter.get_active_submission() == -1 or self.__arbiter.get_is_instructor():
@@ -131,13 +217,10 @@ class SlideViewer(gtk.EventBox):
     
     def remove_local_ink(self, path):
         if self.__arbiter.get_is_instructor():
-            for p in self.__canvas.instr_ink:
-                if p == path:
-                    self.__canvas.instr_ink.remove(p)
+            self.__canvas.instr_ink.remove(path)
         else: 
-            for p in self.__canvas.self_ink:
-                if p == path:
-                    self.__canvas.self_ink.remove(p)
+            self.__canvas.self_ink.remove(path)
+        self.__canvas.ink_removed([path], self.__arbiter.get_is_instructor())
         self.__arbiter.do_remove_local_path_by_uid(path.uid)
     
     def add_local_ink(self, path):
@@ -146,13 +229,15 @@ class SlideViewer(gtk.EventBox):
             self.__canvas.instr_ink.append(path)
         else:
             self.__canvas.self_ink.append(path)
+        self.__canvas.ink_added(path, self.__arbiter.get_is_instructor())
+        self.__canvas.queue_draw_paths([path])
     
     def undo(self):
+        # the actions queue redraws of the ink they change
         if len(self.__canvas.undo_stack) > 0:
             action = self.__canvas.undo_stack.pop()
             action.do_undo()
             self.__canvas.redo_stack.append(action)
-            self.__canvas.queue_draw()
             self.emit('undo-redo-changed')
     
     def redo(self):
@@ -160,7 +245,6 @@ class SlideViewer(gtk.EventBox):
             action = self.__canvas.redo_stack.pop()
             action.do_redo()
             self.__canvas.undo_stack.append(action)
-            self.__canvas.queue_draw()
             self.emit('undo-redo-changed')
     
     def do_button_press_event(self, event):
@@ -171,10 +255,18 @@ class SlideViewer(gtk.EventBox):
             self.__cur_path.pen = self.__canvas.cur_pen    
             self.__cur_path.add((event.x, event.y));
             self.__canvas.add_ink_path(self.__cur_path)
+            self.__streamed = 0
     
     def do_button_release_event(self, event):
         if self.__cur_path:
             self.__cur_path.add((event.x, event.y));
+            # The finished stroke replaces whatever was streamed of it
+            if self.__stream_timer is not None:
+                gobject.source_remove(self.__stream_timer)
+                self.__stream_timer = None
+            self.__simplify_cur_path()
+            # File the finished stroke in the grid; until now it was filed under its first point
+            self.__canvas.update_ink_path(self.__cur_path)
             self.__arbiter.do_add_ink_to_slide(str(self.__cur_path), local_request=True)
             self.__cur_path = None
             self.__canvas.redo_stack = []
@@ -186,9 +278,33 @@ class SlideViewer(gtk.EventBox):
             self.__pos = (event.x, event.y)
             if(self.has_moved()):
                 self.__canvas.draw_ink_seg_immed(self.__last_pos, self.__pos)
+                # Adding a point only grows the stroke's bounding box; it is filed in the
+                # canvas's grid under its final shape once, when the pen is lifted
                 self.__cur_path.add((event.x, event.y));
                 self.__last_pos = self.__pos
+                if self.__stream_timer is None and self.__arbiter.get_is_instructor():
+                    self.__stream_timer = gobject.timeout_add(self.__stream_interval,
+                                                              self.__stream_timeout)
+
+    def __stream_timeout(self):
+        self.__stream_timer = None
+        path = self.__cur_path
+        if path and len(path) > self.__streamed:
+            # Start from the last point already sent so the pieces join up
+            start = max(self.__streamed - 1, 0)
+            self.emit('ink-streamed', inkcodec.encode(path.uid, path.color, path.pen,
+                                                      path.coords[2 * start:]))
+            self.__streamed = len(path)
+        return False
         
+    def __simplify_cur_path(self):
+        before, after = self.__cur_path.simplify(self.__simplify_tolerance)
+        self.__points_drawn += before
+        self.__points_kept += after
+        self.__logger.debug("Simplified stroke from %d to %d points (tolerance %.1fpx); "
+                            "%.0f%% of points kept so far", before, after,
+                            self.__simplify_tolerance, 100 * self.get_simplify_ratio())
+
     def has_moved(self):
         deltaX = self.__pos[0] - self.__last_pos[0]
         deltaY = self.__pos[1] - self.__last_pos[1]
@@ -211,9 +327,21 @@ class SlideViewerCanvas(gtk.DrawingArea):
         self.__logger.setLevel('error')
 
         self.__surface = None
+        # The committed instructor and own ink, each drawn into a surface of its own so
+        # an expose only has to paint them rather than stroke every path
+        self.__instr_overlay = None
+        self.__self_overlay = None
+        self.__overlays_valid = False
+        self.__shown = None     # the n passed to show_slide
+        self.__resize_id = None
+        self.__render_id = None
+        self.__progressive = PROGRESSIVE_RENDER
+        self.__prefetch_id = None
+        self.__prefetch_queue = []
         self.viewer = viewer
-        self.instr_ink = []
-        self.self_ink = []
+        self.instr_ink = InkLayer()
+        self.self_ink = InkLayer()
+        self.pending_ink = {}   # uid -> Path, instructor strokes still being drawn
         self.undo_stack = []
         self.redo_stack = []
         self.cur_pen = None
@@ -222,76 +350,277 @@ class SlideViewerCanvas(gtk.DrawingArea):
     def show_slide(self, n=None):
         timerstart = time.time()
         x, y, width, height = self.allocation
-        self.__surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-        self.__arbiter.do_render_slide_to_surface(self.__surface, n)
-        self.instr_ink = []
-        self.self_ink = []
+        self.__cancel_render()
+        self.__shown = n
+        if self.__progressive and not self.__arbiter.get_slide_is_rendered(width, height, n):
+            # Paint the preview before anything else happens; the full render follows once
+            # the main loop is idle, which is after the redraw
+            self.__cancel_prefetch()
+            self.__surface = self.__arbiter.get_slide_preview(width, height, n)
+            self.__render_id = gobject.idle_add(self.__render_full)
+        else:
+            # Shared with the renderer's cache; only ever painted from
+            self.__surface = self.__arbiter.get_rendered_slide(width, height, n)
+            self.__prefetch_neighbours(n, width, height)
+        self.instr_ink = InkLayer()
+        self.self_ink = InkLayer()
+        self.pending_ink = {}
+        self.__overlays_valid = False
         self.undo_stack = []
         self.redo_stack = []
         instr = self.__arbiter.get_instructor_ink()
         selfink, text = self.__arbiter.get_self_ink_or_submission()
-        for path in instr:
-            self.instr_ink.append(ink.Path(path))
+        for path in ink.paths_from_strings(instr):
+            self.instr_ink.append(path)
             if self.__arbiter.get_is_instructor():
                 self.undo_stack.append(SlideViewer.DrawInkAction(self.viewer, path))
-        for path in selfink:
-            self.self_ink.append(ink.Path(path))
+        for path in ink.paths_from_strings(selfink):
+            self.self_ink.append(path)
             if not self.__arbiter.get_is_instructor():
                 self.undo_stack.append(SlideViewer.DrawInkAction(self.viewer, path))
         self.queue_draw()
         self.__logger.debug("Rendering slide took " + str(time.time() - timerstart) + " seconds")
     
+    def __prefetch_neighbours(self, n, width, height):
+        """Renders the next and previous slides into the renderer's cache while idle, so
+        that moving to them doesn't wait on a render.  Replaces any earlier prefetch."""
+        self.__cancel_prefetch()
+        if n is None:
+            n = self.__arbiter.get_slide_index()
+        self.__prefetch_queue = []
+        for neighbour in (n + 1, n - 1):
+            if 0 <= neighbour < self.__arbiter.get_slide_count():
+                self.__prefetch_queue.append((width, height, neighbour))
+        if len(self.__prefetch_queue) > 0:
+            self.__prefetch_id = gobject.idle_add(self.__prefetch_next, priority=gobject.PRIORITY_LOW)
+
+    def set_progressive(self, progressive):
+        """Sets whether slides are shown as a quick preview while they are rendered"""
+        self.__progressive = progressive
+
+    def __cancel_render(self):
+        """Cancels the full render of the slide after a resize or a preview"""
+        if self.__resize_id is not None:
+            gobject.source_remove(self.__resize_id)
+            self.__resize_id = None
+        if self.__render_id is not None:
+            gobject.source_remove(self.__render_id)
+            self.__render_id = None
+
+    def __render_full(self):
+        self.__render_id = None
+        self.__render_at_current_size()
+        return False
+
+    def __cancel_prefetch(self):
+        if self.__prefetch_id is not None:
+            gobject.source_remove(self.__prefetch_id)
+            self.__prefetch_id = None
+        self.__prefetch_queue = []
+
+    def __prefetch_next(self):
+        # one slide per idle callback, so input is handled between renders
+        width, height, n = self.__prefetch_queue.pop(0)
+        self.__arbiter.do_prefetch_slide(width, height, n)
+        if len(self.__prefetch_queue) > 0:
+            return True
+        self.__prefetch_id = None
+        return False
+
     def add_ink_path(self, path, ink_from_instr=False):
         if self.__arbiter.get_is_instructor() or ink_from_instr:
             self.instr_ink.append(path)
             if self.__arbiter.get_is_instructor():
                 self.undo_stack.append(SlideViewer.DrawInkAction(self.viewer, path))
+            self.ink_added(path, True)
         else:
             self.self_ink.append(path)
             if not self.__arbiter.get_is_instructor():
                 self.undo_stack.append(SlideViewer.DrawInkAction(self.viewer, path))
+            self.ink_added(path, False)
+
+    def ink_added(self, path, instructor):
+        """Draws a stroke just added to instr_ink (or self_ink) into its overlay"""
+        if self.__overlays_valid:
+            if instructor:
+                context = cairo.Context(self.__instr_overlay)
+            else:
+                context = cairo.Context(self.__self_overlay)
+            context.set_line_cap(cairo.LINE_CAP_ROUND)
+            context.set_line_join(cairo.LINE_JOIN_ROUND)
+            self.draw_ink_paths([path], context)
+
+    def ink_removed(self, paths=None, instructor=False):
+        """Takes strokes just removed from instr_ink (or self_ink) off its overlay.  A
+        stroke can't be rubbed out of a surface, so the area it covered is cleared and
+        the strokes that overlap that area are drawn in again.  Without paths, both
+        overlays are redrawn from scratch."""
+        if paths is None or not self.__overlays_valid:
+            self.__overlays_valid = False
+            if paths is None:
+                self.queue_draw()
+            else:
+                self.queue_draw_paths(paths)
+            return
+        if instructor:
+            layer = self.instr_ink
+            overlay = self.__instr_overlay
+        else:
+            layer = self.self_ink
+            overlay = self.__self_overlay
+        for path in paths:
+            area = self.__damage_area(path)
+            if area is None:
+                continue
+            x, y, width, height = area
+            context = cairo.Context(overlay)
+            context.rectangle(x, y, width, height)
+            context.clip()
+            context.set_operator(cairo.OPERATOR_CLEAR)
+            context.paint()
+            context.set_operator(cairo.OPERATOR_OVER)
+            context.set_line_cap(cairo.LINE_CAP_ROUND)
+            context.set_line_join(cairo.LINE_JOIN_ROUND)
+            self.draw_ink_paths(layer.query((x, y, x + width, y + height)), context)
+            self.queue_draw_area(x, y, width, height)
+
+    def queue_draw_paths(self, paths):
+        """Queues a repaint of just the area the given strokes cover"""
+        for path in paths:
+            area = self.__damage_area(path)
+            if area is not None:
+                self.queue_draw_area(*area)
+
+    def __damage_area(self, path):
+        """Returns the (x, y, width, height) of the pixels a stroke covers, or None"""
+        box = path.get_bbox()
+        if box is None:
+            return None
+        # round outwards, with a pixel to spare for antialiasing
+        x0 = int(math.floor(box[0])) - 1
+        y0 = int(math.floor(box[1])) - 1
+        x1 = int(math.ceil(box[2])) + 1
+        y1 = int(math.ceil(box[3])) + 1
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def __update_overlays(self):
+        x, y, width, height = self.allocation
+        if (self.__overlays_valid and self.__instr_overlay.get_width() == width
+                and self.__instr_overlay.get_height() == height):
+            return
+        timerstart = time.time()
+        self.__instr_overlay = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self.__self_overlay = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self.__overlays_valid = True
+        for path in self.instr_ink:
+            self.ink_added(path, True)
+        for path in self.self_ink:
+            self.ink_added(path, False)
+        self.__logger.debug("Redrawing ink overlays took " + str(time.time() - timerstart) + " seconds")
     
+    def add_streamed_ink(self, path):
+        """Extends the pending copy of an instructor stroke with a streamed piece of it"""
+        pending = self.pending_ink.get(path.uid)
+        if pending is None:
+            if self.instr_ink.has_uid(path.uid):
+                # a late piece of a stroke that has already been finished
+                return
+            self.pending_ink[path.uid] = path
+        else:
+            pending.extend(path.coords)
+        if self.window:
+            self.__context = self.window.cairo_create()
+            self.__context.set_line_cap(cairo.LINE_CAP_ROUND)
+            self.__context.set_line_join(cairo.LINE_JOIN_ROUND)
+            self.draw_ink_paths([path])
+
+    def add_finished_ink(self, path):
+        """Adds a finished instructor stroke, replacing its pending copy; adding the
+        same stroke again has no effect"""
+        changed = [path]
+        pending = self.pending_ink.pop(path.uid, None)
+        if pending is not None:
+            changed.append(pending)
+        if not self.instr_ink.has_uid(path.uid):
+            self.add_ink_path(path, ink_from_instr=True)
+        self.queue_draw_paths(changed)
+
+    def update_ink_path(self, path):
+        """Tells the canvas that the points of a stroke already on it have changed"""
+        self.instr_ink.update(path)
+        self.self_ink.update(path)
+
     def draw_ink_seg_immed(self, start, end):
-        self.__context = self.window.cairo_create()
-        self.__context.set_line_cap(cairo.LINE_CAP_ROUND)
-        self.__context.set_line_join(cairo.LINE_JOIN_ROUND)
-        self.__context.set_source_rgb(self.cur_color[0], self.cur_color[1], self.cur_color[2])
-        self.__context.set_line_width(self.cur_pen)
-        self.__context.move_to(start[0], start[1])
-        self.__context.line_to(end[0], end[1])
-        self.__context.stroke()
+        targets = [self.window.cairo_create()]
+        # the stroke being drawn is already in instr_ink or self_ink, so keep its overlay current
+        if self.__overlays_valid:
+            if self.__arbiter.get_is_instructor():
+                targets.append(cairo.Context(self.__instr_overlay))
+            else:
+                targets.append(cairo.Context(self.__self_overlay))
+        for context in targets:
+            context.set_line_cap(cairo.LINE_CAP_ROUND)
+            context.set_line_join(cairo.LINE_JOIN_ROUND)
+            context.set_source_rgb(self.cur_color[0], self.cur_color[1], self.cur_color[2])
+            context.set_line_width(self.cur_pen)
+            context.move_to(start[0], start[1])
+            context.line_to(end[0], end[1])
+            context.stroke()
     
     def do_configure_event(self, event):
-        """Reload the slide when assigned a new height/width"""
-        self.show_slide()
+        """Rescale the slide when assigned a new height/width, and render it afresh once
+        the size settles.  The ink is kept as it is."""
+        x, y, width, height = self.allocation
+        if self.__surface is None:
+            self.show_slide()
+            return
+        if (self.__surface.get_width() == width and self.__surface.get_height() == height
+                and self.__resize_id is None):
+            return
+        self.__surface = self.__arbiter.get_scaled_slide(self.__surface, width, height, self.__shown)
+        # neighbours prefetched at the old size would be no use
+        self.__cancel_prefetch()
+        self.__cancel_render()
+        self.__resize_id = gobject.timeout_add(RESIZE_SETTLE_TIME, self.__resize_settled)
+        self.queue_draw()
+
+    def __resize_settled(self):
+        self.__resize_id = None
+        self.__render_at_current_size()
+        return False
+
+    def __render_at_current_size(self):
+        x, y, width, height = self.allocation
+        self.__surface = self.__arbiter.get_rendered_slide(width, height, self.__shown)
+        self.__prefetch_neighbours(self.__shown, width, height)
+        self.queue_draw()
 
     def do_expose_event (self, event):
         """Draw the slide surface into the DrawingArea"""
         timerstart = time.time()
         if self.__surface:
-            # Draw the (cached) slide
+            # Draw the (cached) slide, only within the area that needs it
             self.__context = self.window.cairo_create()
+            x, y, width, height = event.area
+            self.__context.rectangle(x, y, width, height)
+            self.__context.clip()
             self.__context.set_source_surface(self.__surface, 0, 0)
             self.__context.paint()
+            self.__update_overlays()
+            self.__context.set_source_surface(self.__instr_overlay, 0, 0)
+            self.__context.paint()
+            self.__context.set_source_surface(self.__self_overlay, 0, 0)
+            self.__context.paint()
             self.__context.set_line_cap(cairo.LINE_CAP_ROUND)
             self.__context.set_line_join(cairo.LINE_JOIN_ROUND)
-            self.draw_ink_paths(self.instr_ink)
-            self.draw_ink_paths(self.self_ink)
+            self.draw_ink_paths(self.pending_ink.values())
             
         self.__logger.debug("Exposing slide took " + str(time.time() - timerstart) + " seconds")
 
-    def draw_ink_paths(self, paths):
-        for path in paths:
-            self.__context.set_line_width(path.pen)
-            self.__context.set_source_rgb(path.color[0], path.color[1], path.color[2])
-            start = True
-            for point in path.points:
-                if start:
-                    self.__context.move_to(point[0], point[1])
-                    start = False
-                else:
-                    self.__context.line_to(point[0], point[1])
-            self.__context.stroke()
+    def draw_ink_paths(self, paths, context=None):
+        if context is None:
+            context = self.__context
+        sliderenderer.draw_ink_paths(context, paths)
             
     def get_pen(self):
         return self.cur_pen
@@ -305,7 +634,7 @@ class ThumbViewer(gtk.DrawingArea):
     __gsignals__  = {'expose_event' : 'override',
                     }
     
-    def __init__ (self, arbiter, n):
+    def __init__ (self, arbiter, n=None):
         gtk.DrawingArea.__init__ (self)
 
         self.__arbiter = arbiter
@@ -313,47 +642,74 @@ class ThumbViewer(gtk.DrawingArea):
         self.__logger = logging.getLogger('ThumbViewer')
         self.__logger.setLevel('error')
         
+        self.__n = None
+        self.__requested = False
+        self.__highlighted = False
+        self.set_slide(n)
+
+    def get_slide(self):
+        return self.__n
+
+    def set_slide(self, n):
+        """Shows the thumbnail of slide n; viewers are reused for other slides as the
+        sidebar scrolls.  None shows nothing."""
         self.__n = n
-        self.__was_highlighted = False
-        self.__arbiter.connect_slide_redraw(self.slide_changed)
-        
-        # Load thumbnail from the PNG file, if it exists; otherwise draw from scratch
-        timerstart = time.time()
-        thumb = self.__arbiter.get_slide_thumb(n)
-        if thumb and os.path.exists(thumb):
-            self.__surface = cairo.ImageSurface.create_from_png(thumb)
-        else:
-            self.__surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 200, 150)
-            self.__arbiter.do_render_slide_to_surface(self.__surface, n)
-            
-            # Cache thumbnail
-            name = "slide" + str(n) + "_thumb.png"
-            thumb = os.path.join(self.__arbiter.get_deck_path(), name)
-            self.__surface.write_to_png(thumb)
-            self.__arbiter.do_set_slide_thumb(name, n)
-        self.__logger.debug("Thumbnail loading/drawing took " + str(time.time() - timerstart) + " seconds")
+        self.__requested = False
+        self.queue_draw()
+
+    def set_highlighted(self, highlighted):
+        """Sets whether this is the thumbnail of the current slide; the sidebar keeps
+        track of that, rather than every thumbnail watching for slide changes"""
+        if highlighted != self.__highlighted:
+            self.__highlighted = highlighted
+            self.queue_draw()
+
+    def thumbnail_ready(self):
+        """Shows the thumbnail once the thumbnailer has written it"""
+        self.queue_draw()
+
+    def thumbnail_failed(self):
+        """Lets the thumbnail be asked for again the next time this is drawn.  It isn't
+        redrawn now, so a slide that can't be rendered isn't retried over and over."""
+        self.__requested = False
 
     
     def do_expose_event (self, event):
         """Redraws the slide thumbnail view"""
+        if self.__n is None:
+            return
         timerstart = time.time()
         ctx = self.window.cairo_create()
+        ctx.rectangle(*event.area)
+        ctx.clip()
         x, y, width, height = self.allocation
-        if self.__n == self.__arbiter.get_slide_index():
+        if self.__highlighted:
             ctx.set_source_rgb(0, 1.0, 0)
-            self.__was_highlighted = True
         else:
             ctx.set_source_rgb(0.7, 0.7, 0.7)
-            self.__was_highlighted = False
         ctx.rectangle(0, 0, width, height)
         ctx.fill()
-        if self.__surface:
-            ctx.set_source_surface(self.__surface, 0, 0)
+        # The thumbnail comes from the renderer's cache each time rather than being kept
+        # here, so only as many thumbnails as the cache allows stay in memory
+        surface = self.__arbiter.get_slide_thumbnail(self.__n)
+        if surface is None and not self.__requested:
+            # show a placeholder until the thumbnailer has drawn it
+            self.__requested = True
+            self.__arbiter.do_request_thumbnail(self.__n)
+        if surface:
+            ctx.set_source_surface(surface, 0, 0)
             ctx.rectangle(5, 5, 200, 150)
             ctx.fill()
+        else:
+            # placeholder: a blank slide with its number
+            ctx.set_source_rgb(1.0, 1.0, 1.0)
+            ctx.rectangle(5, 5, 200, 150)
+            ctx.fill()
+            ctx.set_source_rgb(0.7, 0.7, 0.7)
+            ctx.set_font_size(24)
+            label = str(self.__n + 1)
+            x_bearing, y_bearing, text_width, text_height = ctx.text_extents(label)[:4]
+            ctx.move_to(105 - text_width / 2 - x_bearing, 80 - text_height / 2 - y_bearing)
+            ctx.show_text(label)
         self.__logger.debug("Exposing slide thumbnail took " + str(time.time() - timerstart) + " seconds")
      
-    def slide_changed(self, widget):
-        """Updates highlighting, if necessary, when current slide changes"""
-        if self.__was_highlighted != (self.__n == self.__arbiter.get_slide_index()):
-            self.queue_draw()
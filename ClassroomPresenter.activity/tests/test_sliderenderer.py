@@ -0,0 +1,67 @@
+# test_sliderenderer.py
+#
+# Tests for the slide renderer in sliderenderer.py.  Run from the activity folder with
+#   python -m unittest discover -s tests
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import cairo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sliderenderer
+
+class _Arbiter(object):
+    """Just enough of the arbiter for a Renderer to be made"""
+
+    def connect_deck_changed(self, cb):
+        pass
+
+class CorruptLayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.renderer = sliderenderer.Renderer(_Arbiter())
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def write_layer(self, name, data):
+        filename = os.path.join(self.base, name)
+        f = open(filename, "wb")
+        f.write(data)
+        f.close()
+        return filename
+
+    def test_corrupt_layers_are_skipped(self):
+        layers = [self.write_layer("bad.png", "\x89PNG not really a png"),
+                  self.write_layer("bad.svg", "<svg this is not xml"),
+                  self.write_layer("bad.jpg", "not a jpeg")]
+        for layer in layers:
+            self.assertEqual(self.renderer.load_layer(layer), None)
+        # the slide is still drawn, without the damaged layers
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 64, 48)
+        sliderenderer.draw_slide(surface, 640.0, 480.0, layers, self.renderer.load_layer)
+
+    def test_missing_layer_is_skipped(self):
+        self.assertEqual(self.renderer.load_layer(os.path.join(self.base, "gone.svg")), None)
+
+if __name__ == '__main__':
+    unittest.main()
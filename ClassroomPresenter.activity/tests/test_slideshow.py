@@ -0,0 +1,99 @@
+# test_slideshow.py
+#
+# Tests for the deck model in slideshow.py.  Run from the activity folder with
+#   python -m unittest discover -s tests
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import slideshow
+
+DECK_XML = '<?xml version="1.0" encoding="utf-8"?><deck><slide><layer>a.svg</layer></slide></deck>'
+
+class _Arbiter(object):
+    """Just enough of the arbiter for a Deck to move between slides"""
+
+    def get_is_instructor(self):
+        return False
+
+    def get_lock_mode(self):
+        return False
+
+class DeckTextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        f = open(os.path.join(self.base, "deck.xml"), "wb")
+        f.write(DECK_XML)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def open_deck(self):
+        return slideshow.Deck(_Arbiter(), base=self.base)
+
+    def get_text(self, deck):
+        return deck.get_self_ink_or_submission()[1]
+
+    def test_non_ascii_text_survives_journal_and_save(self):
+        deck = self.open_deck()
+        deck.save()
+        # gtk.Entry.get_text() gives UTF-8 encoded str
+        deck.set_slide_text(u"caf\u00e9".encode("utf-8"))
+        self.assertEqual(self.get_text(deck), u"caf\u00e9")
+        deck.flush()
+
+        # the text is only in the journal until the deck is saved again
+        replayed = self.open_deck()
+        self.assertEqual(self.get_text(replayed), u"caf\u00e9")
+
+        replayed.save()
+        self.assertFalse(os.path.exists(os.path.join(self.base, "deck.journal")))
+        saved = self.open_deck()
+        self.assertEqual(self.get_text(saved), u"caf\u00e9")
+
+class DeckSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        f = open(os.path.join(self.base, "deck.xml"), "wb")
+        f.write('<?xml version="1.0" encoding="utf-8"?><deck>'
+                '<slide width="800" height="600"><layer sha1="abc">a.svg</layer></slide></deck>')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_stored_size_is_used_for_the_same_layers(self):
+        deck = slideshow.Deck(_Arbiter(), base=self.base, layer_digests={"a.svg" : "abc"})
+        self.assertEqual(deck.get_slide_dimensions_from_xml(0), [800.0, 600.0])
+
+    def test_stored_size_is_ignored_for_other_layers(self):
+        deck = slideshow.Deck(_Arbiter(), base=self.base, layer_digests={"a.svg" : "def"})
+        self.assertEqual(deck.get_slide_dimensions_from_xml(0), False)
+        # once the size is worked out again it is stored with the new digest
+        deck.set_slide_info(1024, 768, [("svg", "def")], 0)
+        self.assertEqual(deck.get_slide_dimensions_from_xml(0), [1024.0, 768.0])
+
+if __name__ == '__main__':
+    unittest.main()
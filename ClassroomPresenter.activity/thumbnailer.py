@@ -0,0 +1,188 @@
+# thumbnailer.py
+#
+# Renders slide thumbnails in the background, in a pool of worker processes
+# where the multiprocessing module is available.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import glob
+import time
+import logging
+import cairo
+import gobject
+
+import sliderenderer
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python before 2.6; thumbnails are rendered in the activity itself while it is idle
+    multiprocessing = None
+
+THUMB_WIDTH = 200
+THUMB_HEIGHT = 150
+
+# How often (milliseconds) finished thumbnails are collected from the workers
+POLL_INTERVAL = 100
+
+def thumb_name(n):
+    """Returns the file name, relative to the deck folder, of the thumbnail of slide n"""
+    return "slide" + str(n) + "_thumb.png"
+
+def write_thumbnail(surface, filename):
+    """Writes surface to the PNG file filename.  It is written under another name and
+    renamed into place, so a thumbnail is never seen half written."""
+    tmpname = "%s.%d.tmp" % (filename, os.getpid())
+    surface.write_to_png(tmpname)
+    os.rename(tmpname, filename)
+
+def render_thumbnail(job):
+    """Renders one thumbnail to a PNG file and returns the slide index.  Runs in a worker
+    process, so everything it needs is in job: (slide index, layer files, slide size or
+    None to take it from the first layer, output file)."""
+    n, layers, dims, filename = job
+    srcw, srch = sliderenderer.slide_size(layers, dims)
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, THUMB_WIDTH, THUMB_HEIGHT)
+    sliderenderer.draw_slide(surface, float(srcw), float(srch), layers, sliderenderer.open_layer)
+    write_thumbnail(surface, filename)
+    return n
+
+class ThumbnailPool(gobject.GObject):
+    """Renders the thumbnails asked for with request() and emits 'thumbnail-ready' with
+    the slide index as each is written and recorded in the deck, or 'thumbnail-failed' if
+    it could not be rendered.  Uses one worker process per processor."""
+
+    __gsignals__ = {
+        'thumbnail-ready' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_INT,)),
+        'thumbnail-failed' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_INT,)),
+        }
+
+    def __init__(self, arbiter):
+        gobject.GObject.__init__(self)
+
+        self.__arbiter = arbiter
+
+        self.__logger = logging.getLogger('ThumbnailPool')
+        self.__logger.setLevel(logging.DEBUG)
+
+        self.__pool = None
+        self.__results = {}     # slide index -> multiprocessing AsyncResult
+        self.__poll_id = None
+        self.__queue = []       # slide indexes to render here, without worker processes
+        self.__idle_id = None
+        self.__started = {}     # slide index -> time requested, for the log
+
+        self.__arbiter.connect_deck_changed(self.deck_changed_cb)
+        self.__arbiter.connect_quitting(self.quitting_cb)
+
+    def request(self, n):
+        """Asks for the thumbnail of slide n to be rendered"""
+        if n in self.__results or n in self.__queue:
+            return
+        self.__started[n] = time.time()
+        if multiprocessing is not None and self.__pool is None:
+            try:
+                self.__pool = multiprocessing.Pool(multiprocessing.cpu_count())
+                self.__logger.debug("Started %d thumbnail workers", multiprocessing.cpu_count())
+            except OSError, e:
+                self.__logger.error("Can't start thumbnail workers, rendering here: %s", e)
+        if self.__pool is not None:
+            self.__results[n] = self.__pool.apply_async(render_thumbnail, (self.__job(n),))
+            if self.__poll_id is None:
+                self.__poll_id = gobject.timeout_add(POLL_INTERVAL, self.__poll)
+        else:
+            self.__queue.append(n)
+            if self.__idle_id is None:
+                self.__idle_id = gobject.idle_add(self.__render_next, priority=gobject.PRIORITY_LOW)
+
+    def deck_changed_cb(self, widget):
+        self.stop()
+
+    def quitting_cb(self, widget):
+        self.stop()
+
+    def stop(self):
+        """Drops all the work asked for so far.  The workers are stopped, so this must be
+        called before a new deck is unpacked over the old one; otherwise they could still
+        write the old deck's thumbnails over the new deck's."""
+        if self.__poll_id is not None:
+            gobject.source_remove(self.__poll_id)
+            self.__poll_id = None
+        if self.__idle_id is not None:
+            gobject.source_remove(self.__idle_id)
+            self.__idle_id = None
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool = None
+        self.__results = {}
+        self.__queue = []
+        # a worker stopped while writing leaves its temporary file behind
+        for tmpname in glob.glob(os.path.join(self.__arbiter.get_deck_path(), "*_thumb.png.*.tmp")):
+            try:
+                os.remove(tmpname)
+            except OSError, e:
+                self.__logger.error("Can't remove %s: %s", tmpname, e)
+        self.__started = {}
+
+    def __job(self, n):
+        dims = self.__arbiter.get_slide_dimensions_from_xml(n)
+        if dims == False:
+            dims = None
+        filename = os.path.join(self.__arbiter.get_deck_path(), thumb_name(n))
+        return (n, self.__arbiter.get_slide_layers(n), dims, filename)
+
+    def __poll(self):
+        for n, result in self.__results.items():
+            if result.ready():
+                del self.__results[n]
+                try:
+                    result.get()
+                except Exception, e:
+                    self.__failed(n, e)
+                    continue
+                self.__done(n)
+        if len(self.__results) == 0:
+            self.__poll_id = None
+            return False
+        return True
+
+    def __render_next(self):
+        n = self.__queue.pop(0)
+        try:
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, THUMB_WIDTH, THUMB_HEIGHT)
+            self.__arbiter.do_render_slide_to_surface(surface, n)
+            write_thumbnail(surface, os.path.join(self.__arbiter.get_deck_path(), thumb_name(n)))
+        except Exception, e:
+            self.__failed(n, e)
+        else:
+            self.__done(n)
+        if len(self.__queue) == 0:
+            self.__idle_id = None
+            return False
+        return True
+
+    def __failed(self, n, e):
+        self.__logger.error("Rendering the thumbnail of slide %d failed: %s", n, e)
+        self.__started.pop(n, None)
+        self.emit('thumbnail-failed', n)
+
+    def __done(self, n):
+        self.__logger.debug("Thumbnail of slide %d took %f seconds", n,
+                            time.time() - self.__started.pop(n, time.time()))
+        self.__arbiter.do_set_slide_thumb(thumb_name(n), n)
+        self.emit('thumbnail-ready', n)
+
+gobject.type_register(ThumbnailPool)
@@ -1,5 +1,6 @@
 import os
 import gtk
+import hashlib
 
 def getFileType(filename):
 	return os.path.basename(filename).split('.').pop()
@@ -12,6 +13,20 @@ def copy_file(src, dest):
 	f2.write(data)
 	f2.close()
 
+def file_digest(filename):
+	"""Returns the hex SHA-1 digest of a file's contents"""
+	digest = hashlib.sha1()
+	f = open(filename, "rb")
+	try:
+		while True:
+			data = f.read(65536)
+			if not data:
+				break
+			digest.update(data)
+	finally:
+		f.close()
+	return digest.hexdigest()
+
 def run_dialog(header,msg):
 	"""Pops up a blocking dialog box with 'msg'"""
 	dialog = gtk.Dialog(str(header), None, gtk.DIALOG_MODAL,
@@ -28,3 +43,90 @@ def run_dialog(header,msg):
 
 	dialog.run()
 	dialog.destroy()
+
+class LRUCache(object):
+	"""A cache that holds values up to a total size (in bytes, or whatever unit the
+	caller's sizes are in), throwing out the least recently used values to make room"""
+	
+	def __init__(self, budget):
+		self.__budget = budget
+		self.__size = 0
+		self.__entries = {}
+		# Circular doubly linked list of [prev, next, key, value, size] entries, most
+		# recently used first; __head is the sentinel
+		self.__head = [None, None, None, None, 0]
+		self.__head[0] = self.__head
+		self.__head[1] = self.__head
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key, default=None):
+		"""Returns the value cached for key, marking it as most recently used"""
+		entry = self.__entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return default
+		self.hits += 1
+		self.__unlink(entry)
+		self.__push_front(entry)
+		return entry[3]
+	
+	def put(self, key, value, size):
+		"""Caches value under key; values bigger than the whole budget are not kept"""
+		self.discard(key)
+		if size > self.__budget:
+			return
+		entry = [None, None, key, value, size]
+		self.__entries[key] = entry
+		self.__push_front(entry)
+		self.__size += size
+		self.__shrink()
+	
+	def discard(self, key):
+		entry = self.__entries.pop(key, None)
+		if entry is not None:
+			self.__unlink(entry)
+			self.__size -= entry[4]
+	
+	def discard_if(self, predicate):
+		"""Throws out every value whose key predicate(key) is true for"""
+		for key in self.__entries.keys():
+			if predicate(key):
+				self.discard(key)
+	
+	def clear(self):
+		self.__entries = {}
+		self.__head[0] = self.__head
+		self.__head[1] = self.__head
+		self.__size = 0
+	
+	def set_budget(self, budget):
+		self.__budget = budget
+		self.__shrink()
+	
+	def get_budget(self):
+		return self.__budget
+	
+	def get_size(self):
+		return self.__size
+	
+	def __contains__(self, key):
+		return key in self.__entries
+	
+	def __len__(self):
+		return len(self.__entries)
+	
+	def __push_front(self, entry):
+		head = self.__head
+		entry[0] = head
+		entry[1] = head[1]
+		head[1][0] = entry
+		head[1] = entry
+	
+	def __unlink(self, entry):
+		entry[0][1] = entry[1]
+		entry[1][0] = entry[0]
+	
+	def __shrink(self):
+		while self.__size > self.__budget:
+			self.discard(self.__head[0][2])